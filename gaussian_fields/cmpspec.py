@@ -22,7 +22,7 @@ date: 14/05/20
 
 
 import numpy as np
-from numpy.fft import fftn
+from shell_spectrum import shell_spectrum
 
 
 #  ____  _  _   __    __  ____  _  _ 
@@ -36,6 +36,28 @@ def movingaverage(interval, window_size):
     window = np.ones(int(window_size)) / float(window_size)
     return np.convolve(interval, window, 'same')
 
+def shell_tke(r, knorm):
+    """Energy of the field r in shells of integer wavenumber, summed over every mode with np.bincount,
+    see shell_spectrum. The FFT is normalised by the number of points, and shells are rounded to the nearest integer.
+
+    Parameters:
+    ----------------------------------------------------------------
+    r:  float-array
+        The 1D, 2D or 3D random field
+    knorm: float
+        the wavenumber of the first shell, 2 pi / domain size
+    -----------------------------------------------------------------
+    Returns wave_numbers, tke_spectrum: at least as many shells as points along the first axis,
+    more if the field is longer along another axis
+"""
+    n = r.shape[0]
+    # grid spacing 1/m makes the wavenumbers integer mode numbers along each axis
+    power, _ = shell_spectrum(r, spacing=[1.0/m for m in r.shape], bin_width=1.0, rounding='nearest')
+    tke_spectrum = np.zeros(max(n, power.size))
+    tke_spectrum[:power.size] = power/float(r.size)**2
+    wave_numbers = knorm*np.arange(0, tke_spectrum.size) # array of wavenumbers
+    return wave_numbers, tke_spectrum/knorm
+
 
 
 #   __      ____    ____  __  ____  __    ____    ____  ____  ____  ___  ____  ____  _  _  _  _ 
@@ -59,21 +81,9 @@ def compute1Dspectrum(r,lx, smooth):
     -----------------------------------------------------------------
 """
     nx = len(r)
-    nt = nx
-    n = nx
-    rh = fftn(r)/nt
-    # calculate energy in fourier domain
-    tkeh = (rh * np.conj(rh)).real
     k0x = 2.0*np.pi/lx
     knorm = k0x
-    kxmax = nx / 2
-    wave_numbers = knorm*np.arange(0,n) # array of wavenumbers
-    tke_spectrum = np.zeros(len(wave_numbers))
-    for kx in range(-nx//2, nx//2-1):
-        rk = np.sqrt(kx**2)
-        k = int(np.round(rk))
-        tke_spectrum[k] = tke_spectrum[k] + tkeh[kx]
-    tke_spectrum = tke_spectrum/knorm
+    wave_numbers, tke_spectrum = shell_tke(r, knorm)
     knyquist = knorm * nx / 2
     # If smooth parameter is TRUE: Smooth the computed spectrum
     # ONLY for Visualisation
@@ -107,25 +117,10 @@ def compute2Dspectrum(r,lx, ly, smooth):
 """
     nx = len(r[:,0])
     ny = len(r[0,:])
-    nt = nx*ny
-    n = nx
-    rh = fftn(r)/nt
-    # calculate energy in fourier domain
-    tkeh = (rh * np.conj(rh)).real
     k0x = 2.0*np.pi/lx
     k0y = 2.0*np.pi/ly
     knorm = (k0x + k0y) / 2.0
-    kxmax = nx / 2
-    kymax = ny / 2
-    wave_numbers = knorm*np.arange(0,n)
-    tke_spectrum = np.zeros(len(wave_numbers))
-
-    for kx in range(-nx//2, nx//2-1):
-       for ky in range(-ny//2, ny//2-1):
-           rk = np.sqrt(kx**2 + ky**2)
-           k = int(np.round(rk))
-           tke_spectrum[k] = tke_spectrum[k] + tkeh[kx, ky]
-    tke_spectrum = tke_spectrum/knorm
+    wave_numbers, tke_spectrum = shell_tke(r, knorm)
     knyquist = knorm * min(nx, ny) / 2
     # If smooth parameter is TRUE: Smooth the computed spectrum
     # ONLY for Visualisation
@@ -161,28 +156,11 @@ def compute3Dspectrum(r,lx, ly, lz, smooth):
     nx = len(r[:,0,0])
     ny = len(r[0,:,0])
     nz = len(r[0,0,:])
-    nt = nx*ny*nz
-    n = nx
-    rh = fftn(r)/nt
-    # calculate energy in fourier domain
-    tkeh = (rh * np.conj(rh)).real
     k0x = 2.0*np.pi/lx
     k0y = 2.0*np.pi/ly
     k0z = 2.0*np.pi/lz
     knorm = (k0x + k0y + k0z) / 3.0
-    kxmax = nx / 2
-    kymax = ny / 2
-    kzmax = nz / 2
-    wave_numbers = knorm*np.arange(0,n)
-    tke_spectrum = np.zeros(len(wave_numbers))
-
-    for kx in range(-nx//2, nx//2-1):
-       for ky in range(-ny//2, ny//2-1):
-           for kz in range(-nz//2, nz//2-1):
-               rk = np.sqrt(kx**2 + ky**2 + kz**2)
-               k = int(np.round(rk))
-               tke_spectrum[k] = tke_spectrum[k] + tkeh[kx, ky, kz]
-    tke_spectrum = tke_spectrum/knorm
+    wave_numbers, tke_spectrum = shell_tke(r, knorm)
     knyquist = knorm * min(nx, ny, nz) / 2
     # If smooth parameter is TRUE: Smooth the computed spectrum
     # ONLY for Visualisation
@@ -0,0 +1,149 @@
+"""
+Pluggable FFT backend for the generators in turboGen and the spectrum tools in cmpspec and calculate_spectrum_3d.
+
+All of their transforms go through fftn, ifftn, rfftn and irfftn in this module,
+which call the current backend:
+    'numpy' - np.fft, single threaded. The default.
+    'scipy' - scipy.fft, multithreaded with workers (-1 for all cores).
+    'fftw'  - pyfftw, if installed. Plans are made once per shape and kept, with their aligned buffers.
+
+Example:
+    import fft_backend
+    fft_backend.set_backend('scipy', workers=-1)
+    sig = turboGen.gaussian3D_rFFT(200, k41)
+
+    with fft_backend.use_backend('fftw', threads=8):
+        for i in range(1000):
+            sig = turboGen.gaussian3D_rFFT(200, k41, rng=i)
+"""
+
+import numpy as np
+from contextlib import contextmanager
+
+class NumpyFFT:
+    """np.fft"""
+    name = 'numpy'
+
+    def fftn(self, a, s=None, axes=None):
+        return np.fft.fftn(a, s=s, axes=axes)
+
+    def ifftn(self, a, s=None, axes=None):
+        return np.fft.ifftn(a, s=s, axes=axes)
+
+    def rfftn(self, a, s=None, axes=None):
+        return np.fft.rfftn(a, s=s, axes=axes)
+
+    def irfftn(self, a, s=None, axes=None):
+        return np.fft.irfftn(a, s=s, axes=axes)
+
+class ScipyFFT:
+    """scipy.fft, which splits multidimensional transforms over workers threads"""
+    name = 'scipy'
+
+    def __init__(self, workers=-1):
+        import scipy.fft
+        self.fft, self.workers = scipy.fft, workers
+
+    def fftn(self, a, s=None, axes=None):
+        return self.fft.fftn(a, s=s, axes=axes, workers=self.workers)
+
+    def ifftn(self, a, s=None, axes=None):
+        return self.fft.ifftn(a, s=s, axes=axes, workers=self.workers)
+
+    def rfftn(self, a, s=None, axes=None):
+        return self.fft.rfftn(a, s=s, axes=axes, workers=self.workers)
+
+    def irfftn(self, a, s=None, axes=None):
+        return self.fft.irfftn(a, s=s, axes=axes, workers=self.workers)
+
+class FFTW:
+    """pyfftw, with a cache of plans. Each plan owns aligned input and output buffers, which are reused:
+    the input is copied into the plan's buffer, and a copy of the output is returned,
+    so results stay valid after the next transform.
+    """
+    name = 'fftw'
+
+    def __init__(self, threads=1, planner_effort='FFTW_MEASURE'):
+        import pyfftw
+        self.builders = pyfftw.builders
+        self.threads, self.planner_effort = threads, planner_effort
+        self.plans = {}
+
+    def plan(self, kind, a, s=None, axes=None):
+        """The cached plan for a transform of this kind, shape, dtype, s and axes, made on first use"""
+        key = (kind, a.shape, a.dtype.str, None if s is None else tuple(s), None if axes is None else tuple(axes))
+        if key not in self.plans:
+            build = getattr(self.builders, kind)
+            self.plans[key] = build(np.empty_like(a), s=s, axes=axes, threads=self.threads,
+                                    planner_effort=self.planner_effort, avoid_copy=False)
+        return self.plans[key]
+
+    def _run(self, kind, a, s, axes):
+        a = np.asarray(a)
+        return self.plan(kind, a, s, axes)(a).copy()
+
+    def fftn(self, a, s=None, axes=None):
+        return self._run('fftn', a, s, axes)
+
+    def ifftn(self, a, s=None, axes=None):
+        return self._run('ifftn', a, s, axes)
+
+    def rfftn(self, a, s=None, axes=None):
+        return self._run('rfftn', a, s, axes)
+
+    def irfftn(self, a, s=None, axes=None):
+        return self._run('irfftn', a, s, axes)
+
+    def clear(self):
+        '''
+        Forget the cached plans and their buffers
+        '''
+        self.plans = {}
+
+backends = {'numpy': NumpyFFT, 'scipy': ScipyFFT, 'fftw': FFTW}
+
+_backend = NumpyFFT()
+
+def get_backend():
+    """The backend in use"""
+    return _backend
+
+def set_backend(backend='numpy', **kwargs):
+    """Choose the FFT backend for all generators and spectrum tools.
+
+    Args:
+        backend (str or object, optional): a key of backends, or an object with fftn, ifftn, rfftn and irfftn methods. Defaults to 'numpy'.
+        **kwargs: passed to the backend, eg. workers=-1 for 'scipy', threads=8 for 'fftw'
+
+    Returns:
+        object: the previous backend
+    """
+    global _backend
+    previous = _backend
+    if isinstance(backend, str):
+        if backend not in backends:
+            raise ValueError("backend must be one of "+", ".join(backends))
+        backend = backends[backend](**kwargs)
+    _backend = backend
+    return previous
+
+@contextmanager
+def use_backend(backend, **kwargs):
+    """Use a backend within a with block, see set_backend"""
+    previous = set_backend(backend, **kwargs)
+    try:
+        yield _backend
+    finally:
+        set_backend(previous)
+
+def fftn(a, s=None, axes=None):
+    return _backend.fftn(a, s=s, axes=axes)
+
+def ifftn(a, s=None, axes=None):
+    return _backend.ifftn(a, s=s, axes=axes)
+
+def rfftn(a, s=None, axes=None):
+    return _backend.rfftn(a, s=s, axes=axes)
+
+def irfftn(a, s=None, axes=None):
+    return _backend.irfftn(a, s=s, axes=axes)
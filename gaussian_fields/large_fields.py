@@ -0,0 +1,111 @@
+"""
+Out-of-core generation of 3D Gaussian fields which are too large for memory.
+
+gaussian3D_rFFT_file makes the same field as turboGen.gaussianND_rFFT for the same seed,
+but keeps the half spectrum in a memory mapped scratch file and writes the field to a .npy file,
+so only a few slabs are ever in memory. The 3D inverse FFT is split into two passes over slabs:
+    A: an inverse FFT along axis 1 of each slab of axis 0
+    B: an inverse FFT along axis 0, then a real inverse FFT along axis 2, of each slab of axis 1
+Slabs in a pass are independent, so they can be spread over a pool of processes, which share the files.
+
+The output is a plain .npy file, so it can be streamed a slice at a time by
+grid_source.MemmapSlices for the paraxial tracer, or memory mapped with np.load(..., mmap_mode='r').
+
+Example:
+    ne = gaussian3D_rFFT_file('./ne_1001.npy', 500, k41, rng=42, slab=32, processes=8)
+    source = MemmapSlices('./ne_1001.npy')
+"""
+
+import numpy as np
+import os
+from numpy.lib.format import open_memmap
+import fft_backend
+from turboGen import _spectral_amplitude
+
+def _pass_A(args):
+    """Inverse FFT along axis 1 of rows i0:i1 of the spectrum"""
+    spectrum_file, i0, i1 = args
+    W = np.load(spectrum_file, mmap_mode='r+')
+    W[i0:i1] = fft_backend.ifftn(W[i0:i1], axes=(1,))
+    W.flush()
+
+def _pass_B(args):
+    """Inverse FFT along axis 0, then real inverse FFT along axis 2, of columns j0:j1, written to the output"""
+    spectrum_file, output_file, j0, j1 = args
+    W = np.load(spectrum_file, mmap_mode='r')
+    out = np.load(output_file, mmap_mode='r+')
+    w = fft_backend.ifftn(W[:, j0:j1], axes=(0,))
+    out[:, j0:j1] = fft_backend.irfftn(w, s=(out.shape[2],), axes=(2,))
+    out.flush()
+
+def _run(function, tasks, processes):
+    if processes is None:
+        for t in tasks:
+            function(t)
+    else:
+        from multiprocessing import Pool
+        with Pool(processes) as pool:
+            pool.map(function, tasks)
+
+def gaussian3D_rFFT_file(filename, N, k_func, rng=None, slab=16, processes=None, scratch_dir=None, shape=None, dtype=np.float64):
+    """Generate a (2N+1)^3 Gaussian field into a .npy file, slab by slab, see the module docstring.
+    The field is the same as gaussianND_rFFT(shape, k_func, rng) to round-off.
+
+    Arguments:
+        filename {str} -- output .npy file
+        N {int} -- size of domain will be (2*N+1)^3
+        k_func {function} -- a function which takes an input k, in cycles per grid point as np.fft.fftfreq
+        rng {numpy Generator or int} -- random number generator, or a seed for one. Default None, a fresh generator.
+        slab {int} -- number of rows (or columns) of the field in memory at once, per process. Default 16.
+        processes {int} -- number of processes for the FFT passes. Default None, in this process.
+        scratch_dir {str} -- directory for the temporary half spectrum file,
+            about the same size as the output. Default None, next to filename.
+        shape {tuple of 3 int} -- overrides N for any 3D shape. Default None.
+        dtype {numpy dtype} -- float64, or float32 to halve the size of the output and scratch files. Default float64.
+    Returns:
+        signal {memory mapped 3D array of floats} -- the field, opened read only
+    """
+    shape = (2*N+1,)*3 if shape is None else tuple(int(n) for n in shape)
+    if len(shape) != 3:
+        raise ValueError("shape must be 3D")
+    rng = np.random.default_rng(rng)
+    dtype = np.dtype(dtype)
+    half = shape[:2]+(shape[2]//2+1,)
+    scratch_dir = os.path.dirname(os.path.abspath(filename)) if scratch_dir is None else scratch_dir
+    spectrum_file = os.path.join(scratch_dir, os.path.basename(filename)+".spectrum.npy")
+
+    try:
+        # Noise is drawn slab by slab in the order of turboGen._hermitian_noise, so the random stream is the same.
+        # The k=0 (and Nyquist) planes must be made Hermitian before the amplitude is applied, as in gaussianND_rFFT,
+        # so their raw noise and amplitude are kept aside. They are only 2D so fit in memory.
+        W = open_memmap(spectrum_file, mode='w+', dtype=np.result_type(dtype, np.complex64), shape=half)
+        planes = [0] if shape[2]%2 else [0, shape[2]//2]
+        raw = {p: np.empty(shape[:2], dtype=np.complex128) for p in planes}
+        amplitude = {p: np.empty(shape[:2]) for p in planes}
+        for i0 in range(0, shape[0], slab):
+            rows = slice(i0, min(i0+slab, shape[0]))
+            w = rng.standard_normal((rows.stop-i0,)+half[1:]+(2,)).view(np.complex128)[...,0]
+            w *= np.sqrt(2.0)
+            A = _spectral_amplitude(shape, k_func, rows)
+            for p in planes:
+                raw[p][rows], amplitude[p][rows] = w[:,:,p], A[:,:,p]
+            w *= A
+            W[rows] = w
+        for p in planes:
+            P = raw[p]
+            P_neg = np.roll(np.flip(P, (0,1)), 1, (0,1)) # P at -k, index i -> -i mod n
+            P = (P+P_neg.conj())/np.sqrt(2.0)
+            P *= amplitude[p]
+            W[:,:,p] = P
+        W.flush()
+        del W
+
+        out = open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+        del out
+        _run(_pass_A, [(spectrum_file, i0, min(i0+slab, shape[0])) for i0 in range(0, shape[0], slab)], processes)
+        _run(_pass_B, [(spectrum_file, filename, j0, min(j0+slab, shape[1])) for j0 in range(0, shape[1], slab)], processes)
+    finally:
+        if os.path.exists(spectrum_file):
+            os.remove(spectrum_file)
+
+    return np.load(filename, mmap_mode='r')
@@ -0,0 +1,97 @@
+"""
+Power spectra binned in shells of |k|, for fields of any dimension.
+
+The field is transformed once with rfftn, the power of each mode is given an integer shell index from |k|,
+and the shells are summed with np.bincount, so the cost is one FFT and a few passes over the half spectrum.
+Each element of the half spectrum, other than those on the zero and Nyquist planes of the last axis,
+stands for two modes of the full spectrum (k and -k) with the same power and |k|, so it is counted twice.
+
+Both conventions of this package are served:
+    cmpspec: the power summed over shells of integer mode numbers, rounded to the nearest shell
+    calculate_spectrum_3d: the mean power in bins [i*w, (i+1)*w) of |k| in cycles per unit length
+
+Example:
+    power, modes = shell_spectrum(field, spacing=dx, bin_width=0.01, n_bins=100, rounding='floor')
+    mean_power = power/modes
+"""
+
+import numpy as np
+import fft_backend
+
+def half_power(data):
+    """|rfftn(data)|^2 on the half spectrum, and the number of modes of the full spectrum each element stands for.
+
+    Arguments:
+        data {array of floats} -- a real field
+    Returns:
+        power {array of floats} -- the power of each element of the half spectrum
+        modes {1D array of floats} -- 1 or 2 for each element along the last axis, broadcasts against power
+    """
+    F = fft_backend.rfftn(data)
+    n = data.shape[-1]
+    modes = np.full(n//2+1, 2.0)
+    modes[0] = 1.0
+    if n%2 == 0:
+        modes[-1] = 1.0 # Nyquist
+    power = F.real**2
+    power += F.imag**2
+    return power, modes
+
+def half_wavenumber(shape, spacing=1.0):
+    """|k| on the half spectrum of rfftn, with k = fftfreq(M, spacing) along each axis (rfftfreq along the last).
+
+    Arguments:
+        shape {tuple of int} -- shape of the field
+        spacing {float or tuple of float} -- grid spacing along each axis. Default 1, k in cycles per grid point.
+            Use 1/M along each axis for integer mode numbers.
+    Returns:
+        K {array of floats} -- |k| on the half spectrum
+    """
+    spacing = np.broadcast_to(np.asarray(spacing, dtype=float), (len(shape),))
+    d = len(shape)
+    K2 = 0.0
+    for axis, (n, dx) in enumerate(zip(shape, spacing)):
+        k = np.fft.rfftfreq(n, dx) if axis == d-1 else np.fft.fftfreq(n, dx)
+        K2 = K2+k.reshape((-1,)+(1,)*(d-1-axis))**2
+    return np.sqrt(K2)
+
+def shell_spectrum(data, spacing=1.0, bin_width=None, n_bins=None, rounding='floor'):
+    """Sum the power spectrum of a real field in shells of |k|, see the module docstring.
+
+    Arguments:
+        data {array of floats} -- a real field of any dimension
+        spacing {float or tuple of float} -- grid spacing along each axis, see half_wavenumber. Default 1.
+        bin_width {float} -- width of each shell in |k|. Default None, max|k|/n_bins.
+        n_bins {int} -- number of shells. Modes beyond the last shell are counted in it, so max|k| is included.
+            Default None, enough shells for every mode.
+        rounding {str} -- 'floor': shell i is i*bin_width <= |k| < (i+1)*bin_width,
+            'nearest': shell i is centred on i*bin_width. Default 'floor'.
+    Returns:
+        power {1D array of floats} -- |F|^2 of the unnormalised FFT summed over each shell
+        modes {1D array of floats} -- number of modes of the full spectrum in each shell, so power/modes is the mean
+    """
+    if rounding not in ('floor', 'nearest'):
+        raise ValueError("rounding must be 'floor' or 'nearest'")
+    power, modes = half_power(data)
+    K = half_wavenumber(data.shape, spacing)
+    if bin_width is None:
+        if n_bins is None:
+            raise ValueError("give bin_width or n_bins")
+        bin_width = K.max()/n_bins
+
+    if rounding == 'floor':
+        shell = (K/bin_width).astype(np.intp) # |k| >= 0, so truncation is floor
+        # |k| on an edge i*bin_width can round either way in the division, so compare with the edges themselves
+        shell -= K < shell*bin_width
+        shell += K >= (shell+1)*bin_width
+    else:
+        shell = np.rint(K/bin_width).astype(np.intp)
+    shell = shell.ravel()
+    if n_bins is not None:
+        np.minimum(shell, n_bins-1, out=shell)
+    minlength = 0 if n_bins is None else n_bins
+
+    power *= modes
+    modes = np.broadcast_to(modes, power.shape)
+    return (np.bincount(shell, weights=power.ravel(), minlength=minlength),
+            np.bincount(shell, weights=modes.ravel(), minlength=minlength))
@@ -28,6 +28,143 @@ Created: 14/05/2020
 
 
 import numpy as np
+import fft_backend
+
+# Engines for the random-mode (cos) generators. 'loop' is the original point by point summation,
+# 'vector' sums blocks of grid points as matrix products, see _cos_sum_1D/2D/3D.
+cos_engines = ('loop', 'vector')
+
+def _check_engine(engine):
+    if engine not in cos_engines:
+        raise ValueError("engine must be one of "+", ".join(cos_engines))
+
+def _cos_sum_1D(xc, kx, c, block_size):
+    """Vectorised sum over modes of Re(c exp(i kx x)), in blocks of block_size points.
+    With c = A exp(i phi) this is the sum of A cos(kx x + phi).
+    """
+    _r = np.empty(xc.size)
+    for i0 in range(0, xc.size, block_size):
+        Ex = np.exp(1j*np.outer(xc[i0:i0+block_size], kx))
+        _r[i0:i0+block_size] = (Ex @ c).real
+    return _r
+
+def _cos_sum_2D(xc, yc, kx, ky, c1, c2, block_size):
+    """Vectorised sum over modes of A cos(kx x + ky y + phi) + A cos(kx x - ky y + psi), with c1 = A exp(i phi), c2 = A exp(i psi).
+    The phase separates, exp(i(kx x +- ky y)) = exp(i kx x) exp(+-i ky y), so a block of y columns
+    is one matrix product of the x factors with the mode weights of each column.
+    """
+    Ex = np.exp(1j*np.outer(xc, kx)) # nx x nmodes
+    Ey = np.exp(1j*np.outer(yc, ky)) # ny x nmodes
+    _r = np.empty((xc.size, yc.size))
+    bj = max(1, block_size//xc.size)
+    for j0 in range(0, yc.size, bj):
+        ey = Ey[j0:j0+bj]
+        B = ey*c1 + ey.conj()*c2 # block of ny x nmodes
+        _r[:, j0:j0+bj] = (Ex @ B.T).real
+    return _r
+
+def _cos_sum_3D(xc, yc, zc, kx, ky, kz, c1, c2, c3, c4, block_size):
+    """Vectorised sum over modes of A[cos(kx x + ky y + kz z + psi_1) + cos(kx x + ky y - kz z + psi_2)
+    + cos(kx x - ky y + kz z + psi_3) + cos(kx x - ky y - kz z + psi_4)], with c_n = A exp(i psi_n).
+    As in _cos_sum_2D, the y and z factors of a block of z planes are combined with the mode weights,
+    then multiplied by the x factors in one matrix product.
+    """
+    Ex = np.exp(1j*np.outer(xc, kx))
+    Ey = np.exp(1j*np.outer(yc, ky))
+    Ez = np.exp(1j*np.outer(zc, kz))
+    nx, ny, nz = xc.size, yc.size, zc.size
+    _r = np.empty((nx, ny, nz))
+    bk = max(1, block_size//(nx*ny))
+    for k0 in range(0, nz, bk):
+        ez = Ez[k0:k0+bk]
+        P = ez*c1 + ez.conj()*c2 # +ky y terms, block of nz x nmodes
+        Q = ez*c3 + ez.conj()*c4 # -ky y terms
+        B = Ey[:,None,:]*P[None,:,:] + Ey.conj()[:,None,:]*Q[None,:,:] # ny x nz x nmodes
+        _r[:, :, k0:k0+bk] = (Ex @ B.reshape(-1, kx.size).T).real.reshape(nx, ny, -1)
+    return _r
+
+class ModeField:
+    """A random-mode field held as its modes rather than on a grid:
+    n(r) = mean + scale * sum_m A_m cos(k_m . (r - origin) + phase_m)
+    It can be evaluated, with its exact gradient, at any points, eg. ray positions.
+    Make one with gaussian3Dcos(..., modes=True).
+
+    EXAMPLE:
+    field = tg.gaussian3Dcos(lx, ly, lz, nx, ny, nz, nmodes, wn1, especf, modes=True)
+    field.origin = (-lx/2, -ly/2, -lz/2) # centre the field on a cube
+    field.mean, field.scale = n_e0, dn_e/field.std
+    ne, grad = field.evaluate(x, y, z, gradient=True)
+    """
+    def __init__(self, k, amplitude, phase, origin=(0.0, 0.0, 0.0), mean=0.0, scale=1.0):
+        """
+        Parameters:
+        -----------------------------------------------------------------
+        k: float array, M x 3
+            wavevectors of the M modes
+        amplitude: float array, M
+            amplitude of each mode
+        phase: float array, M
+            phase of each mode
+        origin: 3 floats
+            position of the origin of the modes
+        mean: float
+            added to the sum of modes
+        scale: float
+            multiplies the sum of modes
+        -----------------------------------------------------------------
+        """
+        self.k = np.asarray(k, dtype=float)
+        self.amplitude = np.asarray(amplitude, dtype=float)
+        self.phase = np.asarray(phase, dtype=float)
+        self.origin, self.mean, self.scale = origin, mean, scale
+
+    @property
+    def std(self):
+        """Standard deviation of the sum of modes over the ensemble of random phases"""
+        return np.sqrt(0.5*np.sum(self.amplitude**2))
+
+    def key(self):
+        """A hash of the modes and their scaling, identifies the field as a hash of a grid would"""
+        import hashlib
+        h = hashlib.sha1()
+        for a in (self.k, self.amplitude, self.phase, np.array([*self.origin, self.mean, self.scale], dtype=float)):
+            h.update(np.ascontiguousarray(a))
+        return h.hexdigest()
+
+    def evaluate(self, x, y, z, gradient=False, block_size=2**14):
+        """Evaluate the field at N points, summing all modes for blocks of block_size points at a time.
+
+        Parameters:
+        -----------------------------------------------------------------
+        x, y, z: float arrays, N
+            coordinates of the points
+        gradient: bool
+            also return the analytic gradient
+        block_size: integer
+            number of points summed at once, memory use is block_size x M complex numbers
+        -----------------------------------------------------------------
+
+        Returns:
+        N float array, and if gradient is True, 3 x N float array [dn/dx, dn/dy, dn/dz]
+        """
+        x, y, z = (np.asarray(a, dtype=float).ravel() for a in (x, y, z))
+        c = self.scale*self.amplitude*np.exp(1j*self.phase)
+        # columns: the field, and the x, y, z derivatives of each mode, d/dr exp(i k.r) = i k exp(i k.r)
+        W = c[:,None] if not gradient else np.column_stack([c, 1j*self.k*c[:,None]])
+        out = np.empty((W.shape[1], x.size))
+        for i0 in range(0, x.size, block_size):
+            s = slice(i0, i0+block_size)
+            arg = np.outer(x[s]-self.origin[0], self.k[:,0])
+            arg += np.outer(y[s]-self.origin[1], self.k[:,1])
+            arg += np.outer(z[s]-self.origin[2], self.k[:,2])
+            out[:, s] = (np.exp(1j*arg) @ W).real.T
+        if gradient:
+            return self.mean+out[0], out[1:]
+        return self.mean+out[0]
+
+    def gradient(self, x, y, z, block_size=2**14):
+        """Analytic gradient of the field at N points, 3 x N float array"""
+        return self.evaluate(x, y, z, gradient=True, block_size=block_size)[1]
 
 #   __      ____     ___   __   _  _  ____  ____  __   __   __ _     ___  __   ____ 
 #  /  \ ___(    \   / __) / _\ / )( \/ ___)/ ___)(  ) / _\ (  ( \   / __)/  \ / ___)
@@ -37,7 +174,7 @@ import numpy as np
 # this method is from reference: 1988, Yamasaki, "Digital Generation of Non-Goussian Stochastic Fields"
 # Additional reference: Shinozuka, M. and Deodatis, G. (1996) 
 
-def gaussian1Dcos(lx, nx, nmodes, wn1, especf):
+def gaussian1Dcos(lx, nx, nmodes, wn1, especf, engine='vector', block_size=2**20):
     """
      Given a specific energy spectrum, this function generates
      1-D Gaussian field whose energy spectrum corresponds to the  
@@ -55,6 +192,11 @@ def gaussian1Dcos(lx, nx, nmodes, wn1, especf):
         Smallest wavenumber. Typically dictated by spectrum or domain
     espec: function
         A callback function representing the energy spectrum in input
+    engine: string
+        'vector' (default) sums blocks of grid points as array operations,
+        'loop' sums point by point. Both give the same field for the same seed.
+    block_size: integer
+        Number of grid points summed at once by the 'vector' engine, bounds the memory used
     -----------------------------------------------------------------
     
     EXAMPLE:
@@ -83,6 +225,7 @@ def gaussian1Dcos(lx, nx, nmodes, wn1, especf):
     """
     # -----------------------------------------------------------------
 
+    _check_engine(engine)
     # cell size in X-direction
     dx = lx/nx
     # Compute the highest wavenumber (wavenumber cutoff)
@@ -105,11 +248,14 @@ def gaussian1Dcos(lx, nx, nmodes, wn1, especf):
     xc = dx/2.0 + np.arange(0,nx)*dx
     _r = np.zeros(nx)
     print("Generating 1-D turbulence...")
-    for i in range(0,nx):
-        # for every step i along x-direction do the fourier summation
-        arg1 = kx*xc[i] + phi
-        bmx = A_m * np.sqrt(2.0) *(np.cos(arg1))
-        _r[i] = np.sum(bmx)
+    if engine == 'vector':
+        _r = _cos_sum_1D(xc, kx, A_m*np.sqrt(2.0)*np.exp(1j*phi), block_size)
+    else:
+        for i in range(0,nx):
+            # for every step i along x-direction do the fourier summation
+            arg1 = kx*xc[i] + phi
+            bmx = A_m * np.sqrt(2.0) *(np.cos(arg1))
+            _r[i] = np.sum(bmx)
     print("Done! 1-D Turbulence has been generated!")
     return _r
 
@@ -127,7 +273,7 @@ def gaussian1Dcos(lx, nx, nmodes, wn1, especf):
 # this method is from reference: 1988, Yamasaki, "Digital Generation of Non-Goussian Stochastic Fields"
 # Additional reference: Shinozuka, M. and Deodatis, G. (1996) 
 
-def gaussian2Dcos(lx, ly, nx, ny, nmodes, wn1, especf):
+def gaussian2Dcos(lx, ly, nx, ny, nmodes, wn1, especf, engine='vector', block_size=2**20):
     """
      Given a specific energy spectrum, this function generates
      2-D Gaussian field whose energy spectrum corresponds to the  
@@ -149,6 +295,11 @@ def gaussian2Dcos(lx, ly, nx, ny, nmodes, wn1, especf):
         Smallest wavenumber. Typically dictated by spectrum or domain
     espec: function
         A callback function representing the energy spectrum in input
+    engine: string
+        'vector' (default) sums blocks of grid points as array operations,
+        'loop' sums point by point. Both give the same field for the same seed.
+    block_size: integer
+        Approximate number of grid points summed at once by the 'vector' engine, bounds the memory used
     -----------------------------------------------------------------
 
     EXAMPLE:
@@ -189,6 +340,7 @@ def gaussian2Dcos(lx, ly, nx, ny, nmodes, wn1, especf):
     """
     # --------------------------------------------------------------------------
 
+    _check_engine(engine)
     # cell size in X and Y directions
     dx = lx/nx
     dy = ly/ny
@@ -223,13 +375,17 @@ def gaussian2Dcos(lx, ly, nx, ny, nmodes, wn1, especf):
     _r = np.zeros((nx,ny))
 
     print("Generating 2-D turbulence...")
-    for j in range(0,ny):
-        for i in range(0,nx):
-            # for every step i along x-y direction do the fourier summation
-            arg1 = kx*xc[i] + ky*yc[j] + phi
-            arg2 = kx*xc[i] - ky*yc[j] + psi
-            bm = A_m * np.sqrt(2.0) *(np.cos(arg1) + np.cos(arg2))
-            _r[i,j] = np.sum(bm)
+    if engine == 'vector':
+        a = A_m*np.sqrt(2.0)
+        _r = _cos_sum_2D(xc, yc, kx, ky, a*np.exp(1j*phi), a*np.exp(1j*psi), block_size)
+    else:
+        for j in range(0,ny):
+            for i in range(0,nx):
+                # for every step i along x-y direction do the fourier summation
+                arg1 = kx*xc[i] + ky*yc[j] + phi
+                arg2 = kx*xc[i] - ky*yc[j] + psi
+                bm = A_m * np.sqrt(2.0) *(np.cos(arg1) + np.cos(arg2))
+                _r[i,j] = np.sum(bm)
     print("Done! 2-D Turbulence has been generated!")
     return _r
 
@@ -251,7 +407,7 @@ def gaussian2Dcos(lx, ly, nx, ny, nmodes, wn1, especf):
 
 
 
-def gaussian3Dcos(lx, ly, lz, nx, ny, nz, nmodes, wn1, especf):
+def gaussian3Dcos(lx, ly, lz, nx, ny, nz, nmodes, wn1, especf, engine='vector', block_size=2**20, modes=False):
     """
      Given a specific energy spectrum, this function generates
      3-D Gaussian field whose energy spectrum corresponds to the  
@@ -277,6 +433,14 @@ def gaussian3Dcos(lx, ly, lz, nx, ny, nz, nmodes, wn1, especf):
         Smallest wavenumber. Typically dictated by spectrum or domain
     espec: function
         A callback function representing the energy spectrum in input
+    engine: string
+        'vector' (default) sums blocks of grid points as array operations,
+        'loop' sums point by point. Both give the same field for the same seed.
+    block_size: integer
+        Approximate number of grid points summed at once by the 'vector' engine, bounds the memory used
+    modes: bool
+        return the modes as a ModeField instead of evaluating them on the grid.
+        The ModeField evaluated at the cell centres gives the same field.
     -----------------------------------------------------------------
 
     EXAMPLE:
@@ -323,6 +487,7 @@ def gaussian3Dcos(lx, ly, lz, nx, ny, nz, nmodes, wn1, especf):
     """
     # --------------------------------------------------------------------------
 
+    _check_engine(engine)
     # cell size in X, Y, Z directions
     dx = lx/nx
     dy = ly/ny
@@ -355,6 +520,12 @@ def gaussian3Dcos(lx, ly, lz, nx, ny, nz, nmodes, wn1, especf):
     ky = np.sin(theta) * np.sin(phi) * wn;
     kz = np.cos(theta) * wn;
 
+    if modes:
+        # the four terms of the sum below, in the order of psi_1..psi_4
+        k = np.concatenate([np.column_stack([kx, ky, kz]), np.column_stack([kx, ky, -kz]),
+                            np.column_stack([kx, -ky, kz]), np.column_stack([kx, -ky, -kz])])
+        return ModeField(k, np.tile(A_m*np.sqrt(2.0), 4), np.concatenate([psi_1, psi_2, psi_3, psi_4]))
+
     # Computing the vector [xc,yc,zc]
     xc = dx / 2.0 + np.arange(0, nx) * dx
     yc = dy / 2.0 + np.arange(0, ny) * dy
@@ -370,16 +541,21 @@ def gaussian3Dcos(lx, ly, lz, nx, ny, nz, nmodes, wn1, especf):
     _r = np.zeros((nx,ny,nz))
 
     print("Generating 3-D turbulence...")
-    for k in range(0,nz):
-        for j in range(0,ny):
-            for i in range(0,nx):
-                # for every step i along x-y-z direction do the fourier summation
-                arg1 = kx*xc[i] + ky*yc[j] + kz*zc[k] + psi_1
-                arg2 = kx*xc[i] + ky*yc[j] - kz*zc[k] + psi_2
-                arg3 = kx*xc[i] - ky*yc[j] + kz*zc[k] + psi_3
-                arg4 = kx*xc[i] - ky*yc[j] - kz*zc[k] + psi_4
-                bm = A_m * np.sqrt(2.0) * (np.cos(arg1) + np.cos(arg2) + np.cos(arg3) + np.cos(arg4))
-                _r[i,j,k] = np.sum(bm)
+    if engine == 'vector':
+        a = A_m*np.sqrt(2.0)
+        _r = _cos_sum_3D(xc, yc, zc, kx, ky, kz, a*np.exp(1j*psi_1), a*np.exp(1j*psi_2),
+                         a*np.exp(1j*psi_3), a*np.exp(1j*psi_4), block_size)
+    else:
+        for k in range(0,nz):
+            for j in range(0,ny):
+                for i in range(0,nx):
+                    # for every step i along x-y-z direction do the fourier summation
+                    arg1 = kx*xc[i] + ky*yc[j] + kz*zc[k] + psi_1
+                    arg2 = kx*xc[i] + ky*yc[j] - kz*zc[k] + psi_2
+                    arg3 = kx*xc[i] - ky*yc[j] + kz*zc[k] + psi_3
+                    arg4 = kx*xc[i] - ky*yc[j] - kz*zc[k] + psi_4
+                    bm = A_m * np.sqrt(2.0) * (np.cos(arg1) + np.cos(arg2) + np.cos(arg3) + np.cos(arg4))
+                    _r[i,j,k] = np.sum(bm)
 
     print("Done! 3-D Turbulence has been generated!")
     return _r
@@ -429,7 +605,7 @@ def gaussian1D_FFT(N, k_func):
 
     F_shift[0]=0 # 0 mean
 
-    signal=np.fft.ifftn(F_shift)
+    signal=fft_backend.ifftn(F_shift)
     
     return signal.real
 
@@ -481,7 +657,7 @@ def gaussian2D_FFT(N, k_func):
 
     F_shift[0,0]=0 # 0 mean
 
-    signal=np.fft.ifftn(F_shift)
+    signal=fft_backend.ifftn(F_shift)
     
     return signal.real
 
@@ -533,6 +709,339 @@ def gaussian3D_FFT(N, k_func):
 
     F_shift[0,0,0] = 0 # 0 mean
 
-    signal = np.fft.ifftn(F_shift)
+    signal = fft_backend.ifftn(F_shift)
     
-    return signal.real
\ No newline at end of file
+    return signal.real
+
+def _hermitian_noise(shape, rng):
+    """Complex Gaussian noise on the half spectrum used by irfftn, for a real field of the given shape.
+    Each mode has independent real and imaginary parts of variance 2, as the full spectrum noise in gaussian3D_FFT.
+    The planes where the last wavenumber is its own negative (zero, and Nyquist for an even size)
+    are made Hermitian within themselves, W(-k) = W*(k), keeping the same variance.
+    """
+    half = tuple(shape[:-1])+(shape[-1]//2+1,)
+    W = rng.standard_normal(half+(2,)).view(np.complex128)[...,0]
+    W *= np.sqrt(2.0)
+    axes = tuple(range(len(shape)-1))
+    planes = [0] if shape[-1]%2 else [0, shape[-1]//2]
+    for p in planes:
+        P = W[...,p]
+        P_neg = np.roll(np.flip(P, axes), 1, axes) if axes else P # P at -k, index i -> -i mod n
+        W[...,p] = (P+P_neg.conj())/np.sqrt(2.0)
+    return W
+
+def _half_wavenumbers(shape):
+    """Wavenumber axes of the half spectrum used by irfftn, in cycles per grid point,
+    each shaped to broadcast along its own axis only.
+    """
+    d = len(shape)
+    ks = []
+    for axis, n in enumerate(shape):
+        k = np.fft.rfftfreq(n) if axis == d-1 else np.fft.fftfreq(n)
+        ks.append(k.reshape((-1,)+(1,)*(d-1-axis)))
+    return ks
+
+def _spectral_amplitude(shape, k_func, rows=None):
+    """sqrt(k_func(|k|)) on the half spectrum, zero at k=0 so the field has zero mean.
+    rows (a slice with a start) selects a slab of the first axis, for generating large fields in parts.
+    """
+    ks = _half_wavenumbers(shape)
+    if rows is not None:
+        ks[0] = ks[0][rows]
+    K2 = 0.0
+    for k in ks:
+        K2 = K2+k**2
+    with np.errstate(divide='ignore', invalid='ignore'): # k=0 is zeroed below
+        A = np.sqrt(k_func(np.sqrt(K2))) # power spectra follows power law, so sqrt here.
+    A = np.broadcast_to(A, K2.shape).copy() if A.shape != K2.shape else A
+    if rows is None or rows.start == 0:
+        A[(0,)*len(shape)] = 0 # 0 mean
+    return A
+
+def _spectral_gradient(W, shape, spacing=1.0):
+    """Derivatives along each axis of the real field with half spectrum W, by multiplying by 2 pi i k.
+    The Nyquist modes of even sized axes are dropped, as their derivative is not real.
+    Arguments:
+        W {complex array} -- half spectrum, as passed to irfftn
+        shape {tuple of int} -- shape of the field
+        spacing {float or tuple of float} -- grid spacing along each axis. Default 1, derivatives per grid point.
+    Returns:
+        gradient {list of arrays} -- derivative along each axis of the field
+    """
+    spacing = np.broadcast_to(np.asarray(spacing, dtype=float), (len(shape),))
+    gradient = []
+    for k, n, d in zip(_half_wavenumbers(shape), shape, spacing):
+        ik = (2j*np.pi*np.where(np.abs(k) == 0.5, 0.0, k)/d).astype(W.dtype) # keep single precision spectra single
+        gradient.append(fft_backend.irfftn(W*ik, s=shape))
+    return gradient
+
+def _inverse_field(W, shape, gradient=False, spacing=1.0, dtype=np.float64):
+    """The real field (and optionally its spectral derivatives) with half spectrum W, as arrays of dtype.
+    For float32 the spectrum is cast to complex64 first, so backends which support single precision
+    (scipy, pyfftw and numpy >= 2) transform in single precision, at half the memory.
+    """
+    dtype = np.dtype(dtype)
+    W = W.astype(np.result_type(dtype, np.complex64), copy=False)
+    signal = fft_backend.irfftn(W, s=shape).astype(dtype, copy=False)
+    if gradient:
+        return signal, [g.astype(dtype, copy=False) for g in _spectral_gradient(W, shape, spacing)]
+    return signal
+
+def gaussianND_rFFT(shape, k_func, rng=None, gradient=False, spacing=1.0, dtype=np.float64):
+    """A real FFT based generator for scalar gaussian fields of any shape, with the statistics of gaussian3D_FFT.
+    Only the half spectrum used by irfftn is stored, and the wavenumber magnitude is built
+    from broadcast 1-D axes, so time and peak memory are about half those of the full complex generators.
+    To make many realisations with the same shape and spectrum, use GaussianEnsemble.
+    Arguments:
+        shape {tuple of int} -- shape of the field, eg. (2*N+1, 2*N+1, 2*N+1)
+        k_func {function} -- a function which takes an input k, in cycles per grid point as np.fft.fftfreq
+        rng {numpy Generator or int} -- random number generator, or a seed for one. Default None, a fresh generator.
+        gradient {bool} -- also return the exact derivatives of the field along each axis, found spectrally
+            from the same coefficients. Default False.
+        spacing {float or tuple of float} -- grid spacing along each axis, for the derivatives. Default 1, per grid point.
+        dtype {numpy dtype} -- float64, or float32 to halve the memory of the field, its gradients and the transforms.
+            The noise is drawn in double precision, so a float32 field is the float64 one rounded. Default float64.
+    Returns:
+        signal {array of floats} -- a realisation of a Gaussian process.
+        gradient {list of arrays} -- if gradient is True, d(signal)/d(axis) for each axis, in order
+    """
+    rng = np.random.default_rng(rng)
+    shape = tuple(int(n) for n in shape)
+    W = _hermitian_noise(shape, rng)
+    W *= _spectral_amplitude(shape, k_func)
+    return _inverse_field(W, shape, gradient, spacing, dtype)
+
+def gaussian_field(shape, spacing, k_func, rng=None, anisotropic=False, gradient=False, dtype=np.float64):
+    """A Gaussian field on a grid of any shape and spacing, with a spectrum in physical units.
+    Only the requested volume is generated, eg. a long thin box along z rather than a cube cropped afterwards.
+    The wavenumbers are k = 2 pi fftfreq(M, d) along each axis, and k_func is a power spectral density,
+    normalised so the variance of the field is the integral of k_func over all k (in the limit of a fine grid).
+    Like gaussianND_rFFT, only the half spectrum is stored and the field is periodic.
+    Arguments:
+        shape {tuple of int} -- shape of the field, eg. (Mx, My, Mz)
+        spacing {float or tuple of float} -- grid spacing along each axis, eg. (dx, dy, dz)
+        k_func {function} -- spectrum, a function of |k|, or of (kx, ky, kz...) if anisotropic.
+            The components are broadcast 1-D arrays, eg. lambda kx, ky, kz: (kx**2+ky**2+(kz/4)**2)**(-11/6)
+        rng {numpy Generator or int} -- random number generator, or a seed for one. Default None, a fresh generator.
+        anisotropic {bool} -- k_func takes each component of k, rather than its magnitude. Default False.
+        gradient {bool} -- also return the exact derivatives along each axis, in physical units. Default False.
+        dtype {numpy dtype} -- float64, or float32, see gaussianND_rFFT. Default float64.
+    Returns:
+        signal {array of floats} -- a realisation of a Gaussian process.
+        gradient {list of arrays} -- if gradient is True, d(signal)/d(axis) for each axis, in order
+    Example:
+        # a 2 x 2 x 20 mm plasma sampled at 20 um
+        ne = gaussian_field((101, 101, 1001), 0.02, lambda k: k**(-11/3), rng=1)
+    """
+    rng = np.random.default_rng(rng)
+    shape = tuple(int(n) for n in shape)
+    spacing = np.broadcast_to(np.asarray(spacing, dtype=float), (len(shape),))
+    W = _hermitian_noise(shape, rng)
+
+    ks = [2*np.pi*k/d for k, d in zip(_half_wavenumbers(shape), spacing)]
+    with np.errstate(divide='ignore', invalid='ignore'): # k=0 is zeroed below
+        if anisotropic:
+            P = k_func(*ks)
+        else:
+            K2 = 0.0
+            for k in ks:
+                K2 = K2+k**2
+            P = k_func(np.sqrt(K2))
+        # each mode has E|W|^2 = 4 and the inverse FFT divides by the number of points,
+        # so this amplitude makes the variance sum(P dk^d) over the full spectrum
+        dk = np.prod(2*np.pi/(np.array(shape)*spacing))
+        A = np.sqrt(P*dk)*np.prod(shape, dtype=float)/2
+    W *= A
+    W[(0,)*len(shape)] = 0 # 0 mean
+    return _inverse_field(W, shape, gradient, spacing, dtype)
+
+def gaussianND_variance(shape, k_func):
+    """Expected variance of the fields made by gaussianND_rFFT, over realisations.
+    Each mode has E|W|^2 = 4, so the variance is 4 sum(k_func(|k|))/n^2 over the full spectrum.
+    Arguments:
+        shape {tuple of int} -- shape of the field
+        k_func {function} -- a function which takes an input k
+    Returns:
+        variance {float}
+    """
+    shape = tuple(int(n) for n in shape)
+    A2 = _spectral_amplitude(shape, k_func)**2
+    A2[...,1:(shape[-1]+1)//2] *= 2 # half spectrum columns other than 0 and Nyquist stand for two modes each
+    return 4*A2.sum()/np.prod(shape, dtype=float)**2
+
+def gaussianND_projected(shape, k_func, rng=None, spacing=1.0):
+    """Line integral along the last axis of a gaussianND_rFFT field of the given shape, and its transverse gradients,
+    without making the field.
+    By the projection-slice theorem the sum along the last axis is the inverse transform of the k=0 plane
+    of the spectrum, which is itself a Hermitian half spectrum, so only the plane is drawn and transformed.
+    The result has the statistics of integrating a gaussianND_rFFT field, but is not the same realisation for the same seed.
+    Arguments:
+        shape {tuple of int} -- shape of the field being integrated, eg. (2*N+1, 2*N+1, 2*N+1)
+        k_func {function} -- a function which takes an input k, in cycles per grid point as np.fft.fftfreq
+        rng {numpy Generator or int} -- random number generator, or a seed for one. Default None, a fresh generator.
+        spacing {float or tuple of float} -- grid spacing along each axis of the field. Default 1.
+    Returns:
+        column {array of floats} -- the integral along the last axis, shape[:-1]
+        gradient {list of arrays} -- d(column)/d(axis) for each remaining axis
+    """
+    rng = np.random.default_rng(rng)
+    shape = tuple(int(n) for n in shape)
+    spacing = np.broadcast_to(np.asarray(spacing, dtype=float), (len(shape),))
+    plane = shape[:-1]
+    W = _hermitian_noise(plane, rng)
+    W *= _spectral_amplitude(plane, k_func) # |k| in the k=0 plane is the magnitude of the remaining components
+    W *= spacing[-1] # the sum along the axis times its spacing
+    return fft_backend.irfftn(W, s=plane), _spectral_gradient(W, plane, spacing[:-1])
+
+def gaussian3D_projected(N, k_func, rng=None, spacing=1.0):
+    """The z-integral of a (2N+1)^3 gaussian3D_rFFT field and its x, y gradients, at O(N^2 log N) cost,
+    see gaussianND_projected. Eg. for thin screen deflection maps, theta = -d(column)/dx/(2 n_cr).
+    Arguments:
+        N {int}  -- size of domain will be (2*N+1)^3
+        k_func {function} -- a function which takes an input k
+        rng {numpy Generator or int} -- random number generator, or a seed for one. Default None.
+        spacing {float} -- grid spacing. Default 1.
+    Returns:
+        column {2D array of floats} -- line integral along the last axis
+        gradient {list of 2 2D arrays} -- its derivatives along the first two axes
+    Example:
+        col, (d0, d1) = gaussian3D_projected(200, k41, rng=1, spacing=dx)
+    """
+    return gaussianND_projected((2*N+1,)*3, k_func, rng, spacing)
+
+def gaussian1D_rFFT(N, k_func, rng=None, gradient=False, spacing=1.0, dtype=np.float64):
+    """As gaussian1D_FFT, but with a real FFT and a half spectrum, see gaussianND_rFFT.
+    Arguments:
+        N {int}  -- size of domain will be (2*N+1)
+        k_func {function} -- a function which takes an input k
+        rng {numpy Generator or int} -- random number generator, or a seed for one. Default None.
+        gradient {bool} -- also return the spectral derivatives along each axis. Default False.
+        spacing {float} -- grid spacing, for the derivatives. Default 1.
+        dtype {numpy dtype} -- float64, or float32, see gaussianND_rFFT. Default float64.
+    Returns:
+        signal {1D array of floats} -- a realisation of a 1D Gaussian process.
+    """
+    return gaussianND_rFFT((2*N+1,), k_func, rng, gradient, spacing, dtype)
+
+def gaussian2D_rFFT(N, k_func, rng=None, gradient=False, spacing=1.0, dtype=np.float64):
+    """As gaussian2D_FFT, but with a real FFT and a half spectrum, see gaussianND_rFFT.
+    Arguments:
+        N {int}  -- size of domain will be (2*N+1)^2
+        k_func {function} -- a function which takes an input k
+        rng {numpy Generator or int} -- random number generator, or a seed for one. Default None.
+        gradient {bool} -- also return the spectral derivatives along each axis. Default False.
+        spacing {float} -- grid spacing, for the derivatives. Default 1.
+        dtype {numpy dtype} -- float64, or float32, see gaussianND_rFFT. Default float64.
+    Returns:
+        signal {2D array of floats} -- a realisation of a 2D Gaussian process.
+    """
+    return gaussianND_rFFT((2*N+1,)*2, k_func, rng, gradient, spacing, dtype)
+
+def gaussian3D_rFFT(N, k_func, rng=None, gradient=False, spacing=1.0, dtype=np.float64):
+    """As gaussian3D_FFT, but with a real FFT and a half spectrum, see gaussianND_rFFT.
+    A 401^3 field needs about 2 GB rather than the tens of GB of gaussian3D_FFT.
+    Arguments:
+        N {int}  -- size of domain will be (2*N+1)^3
+        k_func {function} -- a function which takes an input k
+        rng {numpy Generator or int} -- random number generator, or a seed for one. Default None.
+        gradient {bool} -- also return the spectral derivatives along each axis. Default False.
+        spacing {float} -- grid spacing, for the derivatives. Default 1.
+        dtype {numpy dtype} -- float64, or float32, see gaussianND_rFFT. Default float64.
+    Returns:
+        signal {3D array of floats} -- a realisation of a 3D Gaussian process.
+    Example:
+        sig = gaussian3D_rFFT(100, k41, rng=42)
+        sig = gaussian3D_rFFT(400, k41, rng=42, dtype=np.float32) # half the memory
+        sig, (d0, d1, d2) = gaussian3D_rFFT(100, k41, rng=42, gradient=True, spacing=dx)
+    """
+    return gaussianND_rFFT((2*N+1,)*3, k_func, rng, gradient, spacing, dtype)
+
+_ensemble = {} # shape and amplitude of the GaussianEnsemble in this worker process
+
+def _init_ensemble(shape, amplitude, dtype=np.float64):
+    _ensemble['shape'], _ensemble['amplitude'], _ensemble['dtype'] = shape, amplitude, dtype
+
+def _ensemble_realisation(seed):
+    shape = _ensemble['shape']
+    W = _hermitian_noise(shape, np.random.default_rng(seed))
+    W *= _ensemble['amplitude']
+    return _inverse_field(W, shape, dtype=_ensemble['dtype'])
+
+class GaussianEnsemble:
+    """Many realisations of a Gaussian field with the same shape and spectrum, as gaussianND_rFFT.
+    The spectral amplitude sqrt(k_func(|k|)) is computed once and kept, so each realisation
+    only draws noise and makes one inverse FFT.
+
+    Realisations come from independent streams spawned from one seed with numpy's SeedSequence,
+    so realisation i is the same whether it is made alone, in a batch or in a worker process.
+
+    EXAMPLE:
+    ens = GaussianEnsemble((201, 201, 201), k41)
+    for sig in ens.realisations(500, seed=42, processes=8):
+        ...
+    for batch in ens.realisations(500, seed=42, batch_size=10): # 10 x 201 x 201 x 201
+        ...
+    """
+    def __init__(self, shape, k_func, dtype=np.float64):
+        """
+        Arguments:
+            shape {tuple of int} -- shape of each field, eg. (2*N+1, 2*N+1, 2*N+1)
+            k_func {function} -- a function which takes an input k, in cycles per grid point as np.fft.fftfreq
+            dtype {numpy dtype} -- float64, or float32, see gaussianND_rFFT. Default float64.
+        """
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.amplitude = _spectral_amplitude(self.shape, k_func)
+
+    def seeds(self, n, seed=None):
+        """n independent child seeds of seed, see numpy.random.SeedSequence.spawn"""
+        return np.random.SeedSequence(seed).spawn(n)
+
+    def realisation(self, rng=None, gradient=False, spacing=1.0):
+        """One realisation.
+        Arguments:
+            rng {numpy Generator, SeedSequence or int} -- random number generator, or a seed for one. Default None.
+            gradient {bool} -- also return the spectral derivatives along each axis, see gaussianND_rFFT. Default False.
+            spacing {float or tuple of float} -- grid spacing, for the derivatives. Default 1.
+        Returns:
+            signal {array of floats} -- a realisation of a Gaussian process.
+        """
+        W = _hermitian_noise(self.shape, np.random.default_rng(rng))
+        W *= self.amplitude
+        return _inverse_field(W, self.shape, gradient, spacing, self.dtype)
+
+    def realisations(self, n, seed=None, batch_size=None, processes=None):
+        """Iterate over n realisations, in order.
+        Arguments:
+            n {int} -- number of realisations
+            seed {int} -- seed of the ensemble. Default None, fresh entropy.
+            batch_size {int} -- if given, yield arrays of batch_size realisations stacked along a new first axis.
+                The last batch may be smaller. Default None, yield realisations one by one.
+            processes {int} -- if given, make realisations in a pool of this many processes.
+                The amplitude is sent to each worker once, when it starts. Default None, in this process.
+        Yields:
+            signal {array of floats} -- a realisation, or a batch of them
+        """
+        seeds = self.seeds(n, seed)
+        if processes is None:
+            fields = (self.realisation(s) for s in seeds)
+            yield from self._batched(fields, batch_size)
+            return
+
+        from multiprocessing import Pool
+        with Pool(processes, initializer=_init_ensemble, initargs=(self.shape, self.amplitude, self.dtype)) as pool:
+            yield from self._batched(pool.imap(_ensemble_realisation, seeds), batch_size)
+
+    @staticmethod
+    def _batched(fields, batch_size):
+        if batch_size is None:
+            yield from fields
+            return
+        batch = []
+        for f in fields:
+            batch.append(f)
+            if len(batch) == batch_size:
+                yield np.stack(batch)
+                batch = []
+        if batch:
+            yield np.stack(batch)
@@ -0,0 +1,231 @@
+"""
+Detector accumulation shared by the paraxial solver and the ray transfer matrix diagnostics.
+
+A detector is a fixed, uniform grid of pixels centred on the optical axis.
+Rays are binned by computing their pixel index arithmetically and counting with np.bincount,
+which is much faster than np.histogram2d for large numbers of rays.
+
+Rays can be deposited into the nearest pixel (ngp, a plain histogram), or spread over neighbouring
+pixels with the area weighted cloud-in-cell (cic) or triangular-shaped-cloud (tsc) kernels.
+The smoother kernels reduce shot noise, so fewer rays are needed for the same image quality.
+Each ray can also carry a weight, eg. its intensity.
+
+Rays need only be binned once, at the native resolution of the camera. Coarser images for any bin_scale
+are derived afterwards by summing blocks of pixels, so the rays can be freed after the first pass.
+
+Example:
+    d = Detector(nx=344, ny=257, Lx=18, Ly=13.5, deposition='cic')
+    for rays in bundles:
+        d.accumulate(rays)
+    H, xedges, yedges = d.H, d.xedges, d.yedges
+
+    d = Detector.from_camera('KAF-8300')
+    d.accumulate(rays)
+    H10, xedges10, yedges10 = d.rebin(10)
+"""
+
+import numpy as np
+
+# Camera presets: native pixel counts and sensor size in mm. Add your own here.
+cameras = {
+    'KAF-8300': dict(pix_x=3448, pix_y=2574, Lx=18, Ly=13.5),
+}
+
+class Detector:
+    """A uniform grid of pixels which accumulates rays into a persistent image.
+    The image H is stored as H[y,x], the same orientation as the transposed output of np.histogram2d.
+    Plain counts are stored as uint32, weighted or smoothed deposition promotes the image to float64.
+    """
+    depositions = ('ngp', 'cic', 'tsc')
+
+    def __init__(self, nx, ny, Lx, Ly, deposition='ngp'):
+        """Create an empty detector.
+
+        Args:
+            nx (int): number of pixels in x
+            ny (int): number of pixels in y
+            Lx (float): detector size in x, in the same units as the rays
+            Ly (float): detector size in y, in the same units as the rays
+            deposition (str, optional): 'ngp' nearest pixel, 'cic' cloud-in-cell or 'tsc' triangular-shaped-cloud. Defaults to 'ngp'.
+        """
+        if deposition not in self.depositions:
+            raise ValueError("deposition must be one of "+", ".join(self.depositions))
+        self.nx, self.ny, self.Lx, self.Ly = int(nx), int(ny), Lx, Ly
+        self.deposition = deposition
+        self.xedges = np.linspace(-Lx/2, Lx/2, self.nx+1)
+        self.yedges = np.linspace(-Ly/2, Ly/2, self.ny+1)
+        dtype = np.uint32 if deposition == 'ngp' else np.float64
+        self.H = np.zeros((self.ny, self.nx), dtype=dtype)
+
+    @classmethod
+    def from_camera(cls, camera, deposition='ngp'):
+        """Create a detector at the native resolution of a camera.
+
+        Args:
+            camera (str): a key of cameras, eg. 'KAF-8300'
+            deposition (str, optional): 'ngp', 'cic' or 'tsc'. Defaults to 'ngp'.
+
+        Returns:
+            Detector: an empty detector
+        """
+        c = cameras[camera]
+        return cls(c['pix_x'], c['pix_y'], c['Lx'], c['Ly'], deposition=deposition)
+
+    def _pixel_coordinates(self, rays):
+        """Position of each ray in units of pixels, measured from the lower detector edge.
+        Only rays which hit the detector are kept, NaN compares False so blocked rays are dropped too.
+        """
+        fx = (rays[0,:]+self.Lx/2)*(self.nx/self.Lx)
+        fy = (rays[2,:]+self.Ly/2)*(self.ny/self.Ly)
+
+        hit = (fx >= 0) & (fx <= self.nx) & (fy >= 0) & (fy <= self.ny)
+        return fx[hit], fy[hit], hit
+
+    def bin_indices(self, rays):
+        """Find the linear pixel index of each ray.
+        Rays which are NaN (blocked by an aperture) or fall outside the detector are dropped.
+        Rays exactly on the upper edge go in the last pixel, as in np.histogram2d.
+
+        Args:
+            rays (4xN float): array representing N rays, [x, theta, y, phi]
+
+        Returns:
+            M int array: linear pixel indices iy*nx+ix of the M rays which hit the detector
+        """
+        fx, fy, _ = self._pixel_coordinates(rays)
+        return self._nearest(fx, fy)
+
+    def _nearest(self, fx, fy):
+        """Linear index of the pixel containing each position"""
+        ix = np.minimum(fx.astype(np.intp), self.nx-1)
+        iy = np.minimum(fy.astype(np.intp), self.ny-1)
+        return iy*self.nx+ix
+
+    def _kernel(self, f):
+        """One dimensional deposition kernel.
+
+        Args:
+            f (N float): ray positions in units of pixels
+
+        Returns:
+            N int array, list: the base pixel of each ray, and (offset, weight) pairs for the pixels it is spread over
+        """
+        if self.deposition == 'cic':
+            u = f-0.5 # measured from the first pixel centre
+            i = np.floor(u)
+            t = u-i
+            return i.astype(np.intp), [(0, 1-t), (1, t)]
+        elif self.deposition == 'tsc':
+            i = np.floor(f) # nearest pixel
+            d = f-i-0.5 # distance from its centre
+            return i.astype(np.intp), [(-1, 0.5*(0.5-d)**2), (0, 0.75-d**2), (1, 0.5*(0.5+d)**2)]
+
+    def _count(self, rays, weights=None):
+        """Pixel counts for a bundle of rays, flattened"""
+        n = self.nx*self.ny
+        fx, fy, hit = self._pixel_coordinates(rays)
+        w = None if weights is None else weights[hit]
+        if self.deposition == 'ngp':
+            return np.bincount(self._nearest(fx, fy), weights=w, minlength=n)
+
+        ix, kx = self._kernel(fx)
+        iy, ky = self._kernel(fy)
+
+        counts = np.zeros(n)
+        for ox, wx in kx:
+            jx = ix+ox
+            in_x = (jx >= 0) & (jx < self.nx) # spread beyond the detector edge is lost
+            for oy, wy in ky:
+                jy = iy+oy
+                inside = in_x & (jy >= 0) & (jy < self.ny)
+                wxy = wx*wy if w is None else wx*wy*w
+                counts += np.bincount((jy*self.nx+jx)[inside], weights=wxy[inside], minlength=n)
+        return counts
+
+    def accumulate(self, rays, weights=None):
+        """Add rays to the detector image.
+
+        Args:
+            rays (4xN float): array representing N rays, [x, theta, y, phi]
+            weights (N float, optional): weight of each ray, eg. intensity. Defaults to None, every ray counts once.
+        """
+        if weights is not None:
+            weights = np.asarray(weights)
+            if self.H.dtype != np.float64:
+                self.H = self.H.astype(np.float64)
+
+        counts = self._count(rays, weights)
+
+        np.add(self.H, counts.reshape(self.ny, self.nx), out=self.H, casting='unsafe')
+
+    def rebin(self, bin_scale):
+        """Sum blocks of bin_scale x bin_scale pixels to make a coarser image.
+        Pixels left over when the detector is not a multiple of bin_scale are trimmed evenly from both sides,
+        so the coarse image stays centred but can be slightly smaller than the detector.
+
+        Args:
+            bin_scale (int): block size, same in x and y
+
+        Returns:
+            MxN array, N+1 array, M+1 array: binned image and bin edges.
+        """
+        bx, by = self.nx//bin_scale, self.ny//bin_scale
+        ox, oy = (self.nx-bx*bin_scale)//2, (self.ny-by*bin_scale)//2 # trimmed pixels on the lower edge
+
+        H = self.H[oy:oy+by*bin_scale, ox:ox+bx*bin_scale]
+        H = H.reshape(by, bin_scale, bx, bin_scale).sum(axis=(1,3), dtype=self.H.dtype)
+        xedges = self.xedges[ox:ox+bx*bin_scale+1:bin_scale]
+        yedges = self.yedges[oy:oy+by*bin_scale+1:bin_scale]
+        return H, xedges, yedges
+
+    def pyramid(self, bin_scales=(1, 10)):
+        """Images at several bin scales from the one accumulation.
+
+        Args:
+            bin_scales (tuple of int, optional): block sizes. Defaults to (1, 10).
+
+        Returns:
+            dict: bin_scale -> (H, xedges, yedges)
+        """
+        return {s: self.rebin(s) for s in bin_scales}
+
+    def clear(self):
+        '''
+        Zero the detector image
+        '''
+        self.H[...] = 0
+
+def histogram(rays, bin_scale=10, pix_x=3448, pix_y=2574, Lx=18, Ly=13.5, deposition='ngp', weights=None):
+    """Bin data into a histogram. Defaults are for a KAF-8300.
+        Outputs are H, the histogram, and xedges and yedges, the bin edges.
+
+    Args:
+        rays (4xN float): array representing N rays
+        bin_scale (int, optional): bin size, same in x and y. Defaults to 10.
+        pix_x (int, optional): number of x pixels in detector plane. Defaults to 3448.
+        pix_y (int, optional): number of y pixels in detector plane. Defaults to 2574.
+        Lx (float, optional): x detector size in consistent units. Defaults to 18.
+        Ly (float, optional): y detector size in consistent units. Defaults to 13.5.
+        deposition (str, optional): 'ngp', 'cic' or 'tsc', see Detector. Defaults to 'ngp'.
+        weights (N float, optional): weight of each ray. Defaults to None.
+
+    Returns:
+        MxN array, N+1 array, M+1 array: binned histogram and bin edges.
+    """
+    d = Detector(pix_x//bin_scale, pix_y//bin_scale, Lx, Ly, deposition=deposition)
+    d.accumulate(rays, weights=weights)
+    return d.H, d.xedges, d.yedges
+
+def plot_histogram(H, xedges, yedges, ax, clim=None, cmap=None):
+    """Plot a detector image, eg. from histogram or Detector.rebin.
+
+    Args:
+        H (MxN float): histogram
+        xedges (N float): x bin edges
+        yedges (M float): y bin edges
+        ax (matplotlib axis): axis to plot to
+        clim (tuple, optional): Limits for imshow Defaults to None.
+        cmap (str, optional): matplotlib colourmap. Defaults to None.
+    """
+    ax.imshow(H, interpolation='nearest', origin='lower', clim=clim, cmap=cmap,
+            extent=[xedges[0], xedges[-1], yedges[0], yedges[-1]], aspect=1)
@@ -3,7 +3,6 @@ Example code for running on hpc using mpiexec
 
 On top of usual requirements to run the particle tracking code it requires:
 
-pickle
 mpi4py
 
 MPI allows multiple nodes to be used while multiprocessing does not
@@ -32,18 +31,19 @@ this variable can be changed to fit into your memory budget. For 48 processors,
 
 bin_scale - this is the ratio of the computational to experimental pixel count, this can be reduced when more rays are considered
 
-Outputs are pickled to keep their object structure, however information on the rays is not saved
+Outputs are saved with result_file.save_results, an image, bin edges and metadata per diagnostic,
+which can be opened without this code (see pickle_plot.py). Information on the rays is not saved
 
 """
 
 import numpy as np
 from time import time
 from mpi4py import MPI
-import pickle
 import sys
 import gc
 import particle_tracker as pt
 import ray_transfer_matrix as rtm
+from result_file import save_results
 
 def full_system_solve(Np,beam_size,divergence,ne_extent,ne_cube):
 	'''
@@ -60,8 +60,7 @@ def full_system_solve(Np,beam_size,divergence,ne_extent,ne_cube):
 	# Save memory by deleting initial ray positions
 	del ss
 	ne_cube.clear_memory()
-	# Convert to mm, a nicer unit
-	rf[0:4:2,:] *= 1e3 
+	# rf is a RayBuffer in m, the diagnostics scale their optics to match
 
 	## Ray transfer matrix
 	b=rtm.BurdiscopeRays(rf)
@@ -151,16 +150,6 @@ b.H  = comm.reduce(b.H,root=0,op=MPI.SUM)
 # Perform file saves on root processor only
 if(rank == 0):
 
-	# Save diagnostics as a pickle
-	# For Schlieren
-	filehandler = open(output_dir+"Schlieren.pkl","wb")
-	pickle.dump(sc,filehandler)
-	filehandler.close()
-	# For Shadowgraphy
-	filehandler = open(output_dir+"Shadowgraphy.pkl","wb")
-	pickle.dump(sh,filehandler)
-	filehandler.close()
-	# For Burdiscope
-	filehandler = open(output_dir+"Burdiscope.pkl","wb")
-	pickle.dump(b,filehandler)
-	filehandler.close()
+	# Save diagnostics as lightweight result files
+	save_results(output_dir, metadata=dict(Np=Np*num_processors),
+				 Schlieren=sc, Shadowgraphy=sh, Burdiscope=b)
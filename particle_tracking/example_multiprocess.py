@@ -21,6 +21,7 @@ from multiprocessing import Pool
 %cd ~/turbulence_tracing/particle_tracking/
 import particle_tracker as pt
 import ray_transfer_matrix as rtm
+from optics import RayBuffer
 
 ##Sinusoidal test
 
@@ -58,8 +59,7 @@ o[1,:]=output[:,1,:].flatten() #theta
 o[2,:]=output[:,2,:].flatten() #y
 o[3,:]=output[:,3,:].flatten() #phi
 
-rf = o #I use rf as notation for the final rays everywhere else, so...
-rf[0:4:2,:] *= 1e3 #convert to mm, a nicer unit
+rf = RayBuffer(o, 'm') #I use rf as notation for the final rays everywhere else, so...
 
 ## Ray transfer matrix
 b=rtm.BurdiscopeRays(rf)
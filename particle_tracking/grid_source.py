@@ -0,0 +1,113 @@
+"""
+Sources of z-slices of electron density, for tracing through grids larger than memory.
+
+The paraxial tracer only ever needs one z-slice at a time, so the density can be streamed:
+from an array in memory, from a memory mapped .npy file, or from a generator which makes slices on demand.
+prefetch reads (and optionally processes) the next slices on a background thread while the current one is traced.
+
+The slices are ne[z, y, x], so a source is indexed along its first axis.
+
+Example:
+    source = MemmapSlices('./ne_2049.npy')
+    for gx, gy in prefetch(source, depth=2, transform=lambda ne: gradient_interpolator(ne, x, y)):
+        ...
+"""
+
+import numpy as np
+import threading
+import queue
+
+class ArraySlices:
+    """Slices of a (2N+1)^3 array in memory.
+    """
+    def __init__(self, ne_grid):
+        self.ne_grid = ne_grid
+
+    def __len__(self):
+        return self.ne_grid.shape[0]
+
+    def __getitem__(self, i):
+        return np.asarray(self.ne_grid[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class MemmapSlices(ArraySlices):
+    """Slices of an array stored in a .npy file, memory mapped so only the slice in use is read.
+    """
+    def __init__(self, filename):
+        """
+        Args:
+            filename (str): .npy file holding an array indexed [z, y, x]
+        """
+        self.filename = filename
+        super().__init__(np.load(filename, mmap_mode='r'))
+
+class GeneratorSlices:
+    """Slices made on demand, eg. by a chunked turbulence generator.
+    """
+    def __init__(self, make_slices, n):
+        """
+        Args:
+            make_slices (function): called with no arguments, returns an iterator over the n slices.
+                It is called again for each pass, so the slices can be traced more than once.
+            n (int): number of slices
+        """
+        self.make_slices, self.n = make_slices, n
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        return iter(self.make_slices())
+
+_done = object() # marks the end of the slices in the prefetch queue
+
+def prefetch(slices, depth=1, transform=None):
+    """Iterate over slices, reading ahead on a background thread.
+
+    Args:
+        slices (iterable): source of slices, eg. MemmapSlices
+        depth (int, optional): number of slices read ahead. Defaults to 1.
+        transform (function, optional): applied to each slice on the background thread,
+            eg. fitting gradient splines. Defaults to None.
+
+    Yields:
+        each slice, or transform(slice)
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        """Queue an item, giving up if the consumer has stopped"""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for s in slices:
+                if not put(s if transform is None else transform(s)):
+                    return
+            put(_done)
+        except Exception as e: # hand errors to the consumer
+            put(e)
+
+    t = threading.Thread(target=worker, daemon=True)
+    t.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        t.join()
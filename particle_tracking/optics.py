@@ -0,0 +1,155 @@
+"""
+Ray buffers and optics shared by the paraxial solver, the particle tracker and the ray transfer matrix diagnostics.
+
+Rays are 4xN arrays, [x, theta, y, phi]. The solvers work in different length units:
+particle_tracker in m, paraxial_solver in mm, and the ray transfer matrix optics are specified in mm.
+A RayBuffer is a plain 4xN numpy array which also records the length unit of its positions,
+so rays can be handed from one solver to another without converting them by hand.
+Consumers scale their own (few) lengths to the units of the rays, rather than scaling the (many) rays.
+
+Angles are always in radians.
+
+Example:
+    rf = ne_cube.solve(s0) # a RayBuffer in m
+    sc = rtm.SchlierenRays(rf) # lenses and detector are scaled to m, the image edges are reported in mm
+    r_mm = rf.to('mm') # an explicit conversion, if one is really needed
+"""
+
+import numpy as np
+
+# Length units, in m
+length_units = {'m': 1.0, 'cm': 1e-2, 'mm': 1e-3, 'um': 1e-6}
+
+def unit_scale(from_unit, to_unit):
+    """Factor which converts a length in from_unit to to_unit, eg. unit_scale('mm', 'm') = 1e-3"""
+    return length_units[from_unit]/length_units[to_unit]
+
+class RayBuffer(np.ndarray):
+    """A 4xN array of rays, [x, theta, y, phi], with the length unit of x and y.
+    It behaves as a normal numpy array, and survives pickling, eg. through multiprocessing.
+    """
+    def __new__(cls, rays, unit='mm'):
+        """Wrap an array of rays, without copying it.
+
+        Args:
+            rays (4xN float): N rays, [x, theta, y, phi]
+            unit (str, optional): length unit of x and y, a key of length_units. Defaults to 'mm'.
+        """
+        if unit not in length_units:
+            raise ValueError("unit must be one of "+", ".join(length_units))
+        r = np.asarray(rays).view(cls)
+        r.unit = unit
+        return r
+
+    def __array_finalize__(self, obj):
+        self.unit = getattr(obj, 'unit', 'mm')
+
+    def __reduce__(self):
+        constructor, args, state = super().__reduce__()
+        return constructor, args, (state, self.unit)
+
+    def __setstate__(self, state):
+        state, self.unit = state
+        super().__setstate__(state)
+
+    def to(self, unit):
+        """A copy of the rays with positions in another unit.
+
+        Args:
+            unit (str): a key of length_units
+
+        Returns:
+            RayBuffer: the converted rays
+        """
+        r = RayBuffer(np.array(self, dtype=np.result_type(self.dtype, np.float32)), unit) # float32 rays stay float32
+        s = unit_scale(self.unit, unit)
+        if s != 1:
+            r[0:4:2,:] *= s
+        return r
+
+def unit_of(rays, default='mm'):
+    """Length unit of some rays: the unit of a RayBuffer, otherwise default"""
+    return rays.unit if isinstance(rays, RayBuffer) else default
+
+def ray_array(rays, unit, default='mm', dtype=np.float64):
+    """Copy rays into a new float array in the given unit, eg. as the working buffer of a solver.
+    Only one pass is made over the rays if no conversion is needed.
+
+    Args:
+        rays (4xN float): N rays, a RayBuffer or a plain array in units of default
+        unit (str): length unit of the copy
+        default (str, optional): unit of plain arrays. Defaults to 'mm'.
+        dtype (numpy dtype, optional): float64, or float32 to halve the memory of the buffer. Defaults to float64.
+
+    Returns:
+        4xN float array: plain numpy array
+    """
+    r = np.array(rays, dtype=dtype)
+    s = unit_scale(unit_of(rays, default), unit)
+    if s != 1:
+        r[0:4:2,:] *= s
+    return r
+
+def transform(matrix, rays):
+    '''
+    Simple wrapper for matrix multiplication
+    '''
+    return np.matmul(matrix,rays)
+
+def distance_matrix(d):
+    '''4x4 numerical matrix for travelling a distance d, the same as lambdifying distance(d)
+    '''
+    return np.array([[1, d, 0, 0],
+                     [0, 1, 0, 0],
+                     [0, 0, 1, d],
+                     [0, 0, 0, 1]], dtype=float)
+
+def lens_matrix(f1, f2):
+    '''4x4 numerical matrix for a thin lens, the same as lambdifying lens(f1, f2)
+    '''
+    return np.array([[1,     0, 0,     0],
+                     [-1/f1, 1, 0,     0],
+                     [0,     0, 1,     0],
+                     [0,     0, -1/f2, 1]], dtype=float)
+
+def lens(f1,f2):
+    '''4x4 symbolic matrix for a thin lens, focal lengths f1 and f2 in orthogonal axes
+    See: https://en.wikipedia.org/wiki/Ray_transfer_matrix_analysis
+    '''
+    import sympy as sym # only needed for symbolic work, slow to import
+    l1= sym.Matrix([[1,    0],
+                    [-1/f1, 1]])
+    l2= sym.Matrix([[1,    0],
+                    [-1/f2, 1]])
+    L=sym.zeros(4,4)
+    L[:2,:2]=l1
+    L[2:,2:]=l2
+    return L
+
+def sym_lens(f):
+    '''
+    helper function to create an axisymmetryic lens
+    '''
+    return lens(f,f)
+
+def distance(d):
+    '''4x4 symbolic matrix for travelling a distance d
+    See: https://en.wikipedia.org/wiki/Ray_transfer_matrix_analysis
+    '''
+    import sympy as sym
+    d = sym.Matrix([[1, d],
+                    [0, 1]])
+    L=sym.zeros(4,4)
+    L[:2,:2]=d
+    L[2:,2:]=d
+    return L
+
+def ray(x, θ, y, ϕ):
+    '''
+    4x1 matrix representing a ray. Spatial units must be consistent, angular units in radians
+    '''
+    import sympy as sym
+    return sym.Matrix([x,
+                       θ,
+                       y,
+                       ϕ])
@@ -1,9 +1,22 @@
+"""
+Paraxial ray tracing through a grid of electron density, slice by slice.
+
+The solver core only needs numpy and scipy, so it imports quickly and runs headless, eg. under MPI or multiprocessing.
+matplotlib (for plotting) and ipywidgets (for NotebookProgress) are only imported when they are used.
+"""
+
 import numpy as np
-import matplotlib.pyplot as plt
-import sympy as sym
-from scipy.interpolate import RectBivariateSpline
-from ipywidgets import FloatProgress
-from turboGen import gaussian3D_FFT, gaussian3Dcos, gaussian2D_FFT, gaussian1D_FFT
+import hashlib
+import os
+import sys
+from multiprocessing import Pool, shared_memory
+from scipy.interpolate import RectBivariateSpline, NdBSpline
+import detector
+from detector import plot_histogram
+from optics import RayBuffer, ray_array, length_units, transform, distance, distance_matrix
+from grid_source import ArraySlices, prefetch
+from tiling import Tiling, periodic_pad, periodic_gradient, grid_period
+from turboGen import gaussian3D_FFT, gaussian3D_rFFT, gaussian3D_projected, gaussianND_variance, gaussian3Dcos, gaussian2D_FFT, gaussian1D_FFT
 
 def power_spectrum(k,a):
     """Simple function for power laws
@@ -33,10 +46,10 @@ def generate_collimated_beam(N, X):
 
     Args:
         N (float): number of rays
-        X (float): size of beam, will generate rays in -X/2 to X/2 in x and y.
+        X (float): size of beam in mm, will generate rays in -X/2 to X/2 in x and y.
 
     Returns:
-        4xN float array: N rays, represented by x, theta, y, phi
+        RayBuffer: N rays in mm, represented by x, theta, y, phi
     """
     rr0=np.random.rand(4,int(N))
     rr0[0,:]-=0.5
@@ -46,29 +59,43 @@ def generate_collimated_beam(N, X):
     scales=np.diag(np.array([X,0,X,0]))
     r0=np.matmul(scales, rr0)
     
-    return r0
-
-L = sym.symbols('L', real=True) # used for sympy
+    return RayBuffer(r0, 'mm')
 
-def transform(matrix, rays):
+def no_progress(i, n):
     '''
-    Simple wrapper for matrix multiplication
-    '''
-    return np.matmul(matrix,rays)
-
-def distance(d):
-    '''4x4 symbolic matrix for travelling a distance d
-    See: https://en.wikipedia.org/wiki/Ray_transfer_matrix_analysis
+    Progress callback which does nothing, the default
     '''
-    d = sym.Matrix([[1, d],
-                    [0, 1]])
-    L=sym.zeros(4,4)
-    L[:2,:2]=d
-    L[2:,2:]=d
-    return L
+    pass
 
-d1=distance(L) #symbolic matrix
-Z1=sym.lambdify([L], d1, "numpy") #a function to return a numpy matrix
+class TextProgress:
+    """Progress callback which prints a text bar, eg. for batch jobs.
+    """
+    def __init__(self, width=40, stream=sys.stdout):
+        self.width, self.stream = width, stream
+
+    def __call__(self, i, n):
+        """Report that step i of n (counting from 0) is starting"""
+        done = self.width*(i+1)//n
+        if i == 0 or done != self.width*i//n: # only redraw when the bar grows
+            self.stream.write("\rProgress: [%s%s] %d/%d"%('#'*done, ' '*(self.width-done), i+1, n))
+            if i+1 == n:
+                self.stream.write("\n")
+            self.stream.flush()
+
+class NotebookProgress:
+    """Progress callback which shows an ipywidgets progress bar in a Jupyter notebook.
+    """
+    def __init__(self):
+        self.bar = None
+
+    def __call__(self, i, n):
+        """Report that step i of n (counting from 0) is starting"""
+        if self.bar is None:
+            from ipywidgets import FloatProgress
+            from IPython.display import display
+            self.bar = FloatProgress(min=0, max=n, description='Progress:')
+            display(self.bar)
+        self.bar.value = i+1
 
 def gradient_interpolator(ne, x, y):
     """Deceptively simple. First we take the gradient of ne, use a second order centered differences approach
@@ -83,13 +110,90 @@ def gradient_interpolator(ne, x, y):
         RectBivariateSpline tuple: Two functions which take coordinates and return values of the gradient.
     """
     grad_ney, grad_nex=np.gradient(ne, y, x)
+    return gradient_splines(grad_nex, grad_ney, x, y)
+
+def gradient_splines(grad_nex, grad_ney, x, y):
+    """Bivariate splines through a gradient which is already known, eg. found spectrally.
+
+    Args:
+        grad_nex (NxM float array): x gradient of the electron density
+        grad_ney (NxM float array): y gradient of the electron density
+        x (M float array): x coordinates
+        y (N float array): y coordinates
+
+    Returns:
+        RectBivariateSpline tuple: Two functions which take coordinates and return values of the gradient.
+    """
     gx=RectBivariateSpline(y,x,grad_nex)
     gy=RectBivariateSpline(y,x,grad_ney)
     
     return gx, gy
 
+class CoefficientSpline:
+    """A bicubic spline evaluated from stored knots and coefficients, without fitting it again.
+    Called as a RectBivariateSpline with grid=False, which is all the solvers need.
+    Positions beyond the knots are clamped to them, as FITPACK does when evaluating a RectBivariateSpline.
+    """
+    def __init__(self, tx, ty, c, k=3):
+        """
+        Args:
+            tx (float array): knots in y, the first argument of the spline
+            ty (float array): knots in x
+            c (float array): spline coefficients, flattened as in RectBivariateSpline.get_coeffs
+            k (int, optional): spline degree. Defaults to 3.
+        """
+        self.bounds = (tx[k], tx[-k-1]), (ty[k], ty[-k-1])
+        c = np.asarray(c, dtype=np.float64).reshape(len(tx)-k-1, len(ty)-k-1)
+        self.spline = NdBSpline((tx, ty), c, k)
+
+    def __call__(self, y, x, grid=False):
+        if grid:
+            raise ValueError("CoefficientSpline is only evaluated at points, use grid=False")
+        (y0, y1), (x0, x1) = self.bounds
+        y = np.clip(y, y0, y1)
+        x = np.clip(x, x0, x1)
+        return self.spline(np.stack(np.broadcast_arrays(y, x), axis=-1))
+
+def spline_from_coefficients(tx, ty, c, k=3):
+    """Rebuild a gradient spline from its knots and coefficients, see CoefficientSpline.
+
+    Args:
+        tx (float array): knots in y, the first argument of the spline
+        ty (float array): knots in x
+        c (float array): spline coefficients
+        k (int, optional): spline degree. Defaults to 3.
+
+    Returns:
+        CoefficientSpline: the spline
+    """
+    return CoefficientSpline(tx, ty, c, k)
+
+def tile_gradients(grad_nex, grad_ney, tiling, t, origin, period):
+    """Gradient functions of tile t of a periodic grid, see tiling.py.
+    Positions are mapped into the grid before the splines are evaluated, and the gradients of reflected tiles are reversed.
+
+    Args:
+        grad_nex (RectBivariateSpline): x gradient of the grid, fitted over a whole period
+        grad_ney (RectBivariateSpline): y gradient of the grid, fitted over a whole period
+        tiling (Tiling): shifts and reflections of the tiles
+        t (int): tile
+        origin (2 float): lowest x and y of the grid
+        period (2 float): period of the grid in x and y
+
+    Returns:
+        function tuple: Two functions which take coordinates and return values of the gradient, like the splines.
+    """
+    def tiled(grad, axis):
+        def g(ys, xs, grid=False):
+            xl, sx = tiling.local(t, xs, 0, origin[0], period[0])
+            yl, sy = tiling.local(t, ys, 1, origin[1], period[1])
+            return (sx, sy)[axis]*grad(yl, xl, grid=grid)
+        return g
+    return tiled(grad_nex, 0), tiled(grad_ney, 1)
+
 def deflect_rays(rays, grad_nex,grad_ney, dz, n_cr=1.21e21):
-    """Deflects rays at a slice based on the gradient of the electron density
+    """Deflects rays at a slice based on the gradient of the electron density.
+    Rays are deflected down the gradient, d(theta)/dz = -d(n_e)/dx /(2 n_cr), as in particle_tracker.
 
     Args:
         rays (4xN float): array representing N rays
@@ -101,66 +205,200 @@ def deflect_rays(rays, grad_nex,grad_ney, dz, n_cr=1.21e21):
     Returns:
         4xN float array: rays after deflection
     """
-    n_cr=1.21e21 #cm^-3, assumes ne has the same units
     xs=rays[0,:]
     ys=rays[2,:]
     dangle=np.zeros_like(rays)
-    dangle[1,:]=grad_nex(ys, xs, grid=False)*dz/(2*n_cr)
-    dangle[3,:]=grad_ney(ys, xs, grid=False)*dz/(2*n_cr)
+    dangle[1,:]=-grad_nex(ys, xs, grid=False)*dz/(2*n_cr)
+    dangle[3,:]=-grad_ney(ys, xs, grid=False)*dz/(2*n_cr)
     return rays+dangle
 
-def histogram(rays, bin_scale=10, pix_x=1000, pix_y=1000, Lx=10,Ly=10):
-    """Bin data into a histogram. Defaults are for a KAF-8300.
+def advance_slice(rays, grad_nex, grad_ney, dz, n_cr=1.21e21, buffer=None, max_grad=None):
+    """Deflect rays at a slice and advance them by dz, updating the ray buffer in place.
+    This is deflect_rays followed by transform(distance_matrix(dz), rays), without allocating new 4xN arrays.
+
+    Args:
+        rays (4xN float): array representing N rays, updated in place
+        grad_nex (RectBivariateSpline): function which take coordinates and return values of the gradient
+        grad_ney (RectBivariateSpline): function which take coordinates and return values of the gradient
+        dz (float): distance in z which each slice covers. Use a consistent system
+        n_cr (float, optional): critical density. Defaults to 1 um laser in cm^-3
+        buffer (N float, optional): scratch space, reuse it between slices to avoid allocation. Defaults to None.
+        max_grad (N float, optional): if given, updated in place with the largest |gradient| component seen by each ray. Defaults to None.
+
+    Returns:
+        4xN float array: rays, the same array
+    """
+    x, theta, y, phi = rays
+    if buffer is None:
+        buffer = np.empty_like(x)
+
+    for angle, grad in ((theta, grad_nex), (phi, grad_ney)):
+        g = grad(y, x, grid=False)
+        if max_grad is not None:
+            np.maximum(max_grad, np.abs(g), out=max_grad)
+        np.multiply(g, dz, out=g)
+        np.divide(g, 2*n_cr, out=g)
+        angle -= g # down the gradient, as deflect_rays
+
+    np.multiply(theta, dz, out=buffer)
+    x += buffer
+    np.multiply(phi, dz, out=buffer)
+    y += buffer
+    return rays
+
+def histogram(rays, bin_scale=10, pix_x=1000, pix_y=1000, Lx=10,Ly=10, deposition='ngp', weights=None):
+    """Bin data into a histogram, using the shared detector binning.
         Outputs are H, the histogram, and xedges and yedges, the bin edges.
 
     Args:
         rays (4xN float): array representing N rays
         bin_scale (int, optional): bin size, same in x and y. Defaults to 10.
-        pix_x (int, optional): number of x pixels in detector plane. Defaults to 3448.
-        pix_y (int, optional): number of y pixels in detector plane. Defaults to 2574.
+        pix_x (int, optional): number of x pixels in detector plane. Defaults to 1000.
+        pix_y (int, optional): number of y pixels in detector plane. Defaults to 1000.
         Lx (int, optional): x detector size in consistent units. Defaults to 10.
         Ly (int, optional): y detector size in consistent units. Defaults to 10.
+        deposition (str, optional): 'ngp', 'cic' or 'tsc', see detector.Detector. Defaults to 'ngp'.
+        weights (N float, optional): weight of each ray. Defaults to None.
 
     Returns:
         MxN array, M array, N array: binned histogram and bin edges.
     """
-    x=rays[0,:]
-    y=rays[2,:]
+    return detector.histogram(rays, bin_scale=bin_scale, pix_x=pix_x, pix_y=pix_y, Lx=Lx, Ly=Ly,
+                              deposition=deposition, weights=weights)
 
-    x=x[~np.isnan(x)]
-    y=y[~np.isnan(y)]
+def share_array(a):
+    """Copy an array into shared memory, so worker processes can use it without a copy each.
 
-    H, xedges, yedges = np.histogram2d(x, y, 
-                                       bins=[pix_x//bin_scale, pix_y//bin_scale],
-                                      range=[[-Lx/2, Lx/2],[-Ly/2,Ly/2]])
-    H=H.T
-    return H, xedges, yedges
+    Args:
+        a (float array): array to share
 
-def plot_histogram(H, xedges, yedges, ax, clim=None, cmap=None):
-    """[summary]
+    Returns:
+        SharedMemory, tuple: the shared block (close and unlink it when done), and a spec for attach_array
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+    np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+    return shm, (shm.name, a.shape, a.dtype.str)
+
+def attach_array(spec):
+    """Attach to an array shared by share_array.
 
     Args:
-        H (MxN float): histogram
-        xedges (N float): x bin edges
-        yedges (M float): y bin edges
-        ax (matplotlib axis): axis to plot to
-        clim (tuple, optional): Limits for imshow Defaults to None.
-        cmap (str, optional): matplotlib colourmap. Defaults to None.
+        spec (tuple): name, shape and dtype from share_array
+
+    Returns:
+        SharedMemory, array: keep a reference to the SharedMemory for as long as the array is used
     """
-    ax.imshow(H, interpolation='nearest', origin='low', clim=clim, cmap=cmap,
-            extent=[xedges[0], xedges[-1], yedges[0], yedges[-1]], aspect=1)
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+_worker = {} # per process state for the parallel solver
+
+def _init_worker(specs, dz, tiles=None):
+    """Pool initializer, attach to the shared spline coefficients"""
+    _worker['shm'], arrays = zip(*[attach_array(spec) for spec in specs])
+    _worker['splines'] = arrays
+    _worker['dz'] = dz
+    _worker['tiles'] = tiles
+
+def _trace_chunk(args):
+    """Advance a chunk of rays through all the slices, in a worker process.
+
+    Args:
+        args (tuple): 4xN rays, and detector settings (nx, ny, Lx, Ly, deposition) or None
+
+    Returns:
+        4xN float or MxN array: final rays, or the partial detector image if detector settings are given
+    """
+    rt, detector_args = args
+    rt = np.array(rt) # own, contiguous buffer to update in place, in the precision of the tracer
+    tx, ty, cx, cy = _worker['splines']
+    dz = _worker['dz']
+    tiling, origin, period = _worker['tiles'] or (None, None, None)
+    buffer = np.empty(rt.shape[1], dtype=rt.dtype)
+    for t in range(1 if tiling is None else tiling.n_tiles):
+        for i in range(cx.shape[0]):
+            gx = spline_from_coefficients(tx, ty, cx[i])
+            gy = spline_from_coefficients(tx, ty, cy[i])
+            if tiling is not None:
+                gx, gy = tile_gradients(gx, gy, tiling, t, origin, period)
+            advance_slice(rt, gx, gy, dz=dz, buffer=buffer)
+
+    if detector_args is None:
+        return rt
+    d = detector.Detector(*detector_args)
+    d.accumulate(rt)
+    return d.H
 
 class GridTracer:
     """
     Provides the functions for examining and tracing rays through a grid of electron density.
     Inherit from this and implement __init__ for different grid configurations.
+
+    x, y and z are in the length unit of the class, mm. Rays can be passed as a RayBuffer in any unit,
+    or as plain arrays in mm. The traced rays self.rt are a RayBuffer in mm,
+    so they can be passed straight to the ray_transfer_matrix diagnostics.
+
+    Set dtype to np.float32 to trace float32 rays through float32 spline coefficients, halving the memory
+    of the rays, the spline cache and the shared memory of solve_parallel. Splines are still fitted and evaluated
+    in float64, and each slice adds a small deflection, so the angles lose little by being accumulated in float32.
     """
+    unit = 'mm'
+    dtype = np.float64
+    tiling = None
+
+    def tile(self, n_tiles, shifts=False, reflections=False, rng=None):
+        """Repeat the grid periodically along z, see tiling.py. The grid should be periodic, eg. from gaussian3D_FFT.
+        The rays then cross n_tiles grids, and rays which leave through the sides re-enter on the other side.
+        solve, solve_parallel and StreamedGrid.solve trace the tiles. The gradient splines are refitted over a whole period.
+
+        Args:
+            n_tiles (int): number of grids along z
+            shifts (bool, optional): shift each tile by a random fraction of the period in x and y. Defaults to False.
+            reflections (bool, optional): reflect each tile in x and/or y at random. Defaults to False.
+            rng (numpy Generator or int, optional): random number generator, or a seed for one. Defaults to None.
+        """
+        self.tiling = Tiling(n_tiles, shifts, reflections, rng)
+        self.clear_spline_cache()
+
+    def _tiles(self):
+        """Tiling, grid origin and period, as taken by tile_gradients, or None if not tiled"""
+        if self.tiling is None:
+            return None
+        return self.tiling, (self.x[0], self.y[0]), (grid_period(self.x), grid_period(self.y))
+
+    def fit_slice(self, ne_slice, i=None):
+        """Gradient splines of one z-slice. If the grid is tiled, they are periodic and cover a whole period.
+
+        Args:
+            ne_slice (NxM float array): electron density
+            i (int, optional): index of the slice, to use precomputed gradients in self.grad_grid. Defaults to None.
+
+        Returns:
+            RectBivariateSpline tuple: x and y gradient splines
+        """
+        grad_grid = getattr(self, 'grad_grid', None)
+        if self.tiling is None:
+            if grad_grid is not None and i is not None:
+                return gradient_splines(grad_grid[0][i], grad_grid[1][i], self.x, self.y)
+            return gradient_interpolator(ne_slice, self.x, self.y)
+
+        if grad_grid is not None and i is not None:
+            gx, gy = grad_grid[0][i], grad_grid[1][i]
+        else:
+            gx = periodic_gradient(ne_slice, self.x[1]-self.x[0], axis=1)
+            gy = periodic_gradient(ne_slice, self.y[1]-self.y[0], axis=0)
+        _, origin, period = self._tiles()
+        x, y = np.append(self.x, origin[0]+period[0]), np.append(self.y, origin[1]+period[1])
+        return gradient_splines(periodic_pad(gx, (0, 1)), periodic_pad(gy, (0, 1)), x, y)
+
     def plot_ne_slices(self):
         """Plot 9 slices from the density grid, for inspection
 
         Returns:
             fig, ax: matplotlib figure and axis.
         """
+        import matplotlib.pyplot as plt
         fig,ax=plt.subplots(3,3, figsize=(8,8), sharex=True, sharey=True)
         ax=ax.flatten()
 
@@ -174,44 +412,353 @@ class GridTracer:
             
         return fig, ax
     
-    def solve(self, r0):
+    def ne_slices(self):
+        """The z-slices of the density grid, in order. Override this to stream slices from elsewhere.
+
+        Returns:
+            iterable: NxM float arrays
+        """
+        return ArraySlices(self.ne_grid)
+
+    def grid_key(self):
+        """A hash of the density grid and its coordinates, used to key cached splines
+
+        Returns:
+            str: hex digest
+        """
+        h = hashlib.sha1()
+        for ne_slice in self.ne_slices():
+            h.update(np.ascontiguousarray(ne_slice))
+        for a in (self.x, self.y, self.z):
+            h.update(np.ascontiguousarray(a))
+        if getattr(self, 'grad_grid', None) is not None: # splines fitted to spectral gradients differ
+            h.update(b'spectral')
+        if self.tiling is not None: # as do periodic splines
+            h.update(b'periodic')
+        if np.dtype(self.dtype) != np.float64: # and single precision coefficients
+            h.update(np.dtype(self.dtype).name.encode())
+        return h.hexdigest()
+
+    def slice_splines(self, cache_dir=None):
+        """Gradient spline coefficients for every z-slice. These are found once per grid and kept,
+        so repeated solves through the same grid only interpolate.
+        The knots depend only on x and y, so they are shared by all slices.
+        If the density grid is changed, call clear_spline_cache.
+
+        Args:
+            cache_dir (str, optional): directory for an on-disk cache, keyed by the grid contents. Defaults to None.
+
+        Returns:
+            tx, ty, cx, cy: knots, and (2N+1)xK coefficients of the x and y gradient splines for each slice
+        """
+        if getattr(self, 'splines', None) is not None:
+            return self.splines
+
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = os.path.join(cache_dir, "splines_"+self.grid_key()[:16]+".npz")
+            if os.path.exists(cache_file):
+                with np.load(cache_file) as f:
+                    self.splines = f['tx'], f['ty'], f['cx'], f['cy']
+                return self.splines
+
+        cx, cy = [], []
+        for i, ne_slice in enumerate(self.ne_slices()):
+            gx, gy = self.fit_slice(ne_slice, i)
+            cx.append(gx.get_coeffs())
+            cy.append(gy.get_coeffs())
+        tx, ty = gx.get_knots()
+        self.splines = tx, ty, np.array(cx, dtype=self.dtype), np.array(cy, dtype=self.dtype)
+
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_file, tx=tx, ty=ty, cx=self.splines[2], cy=self.splines[3])
+        return self.splines
+
+    def clear_spline_cache(self):
+        '''
+        Forget the in-memory gradient splines, eg. after changing ne_grid
+        '''
+        self.splines = None
+
+    def solve(self, r0, cache_dir=None, progress=no_progress):
         """Trace rays through the turbulent grid
 
         Args:
             r0 (4xN float): array of N rays, in their initial configuration
+            cache_dir (str, optional): directory for an on-disk cache of the gradient splines. Defaults to None.
+            progress (function, optional): called as progress(i, n) at each slice,
+                eg. TextProgress() or NotebookProgress(). Defaults to no_progress.
         """
-        f = FloatProgress(min=0, max=self.ne_grid.shape[0], description='Progress:')
-        display(f)
-        
         self.r0 = r0 # keep the original
         dz = self.z[1]-self.z[0]
-        DZ = Z1(dz) # matrix to push rays by dz
-
-        rt = r0.copy() # iterate to save memory, starting at r0
-
-        for i, ne_slice in enumerate(self.ne_grid):
-            f.value = i
 
-            gx, gy = gradient_interpolator(ne_slice, self.x, self.y)
-            rr1 = deflect_rays(rt, gx, gy, dz=dz)
-            rt = transform(DZ, rr1)
+        rt = ray_array(r0, self.unit, dtype=self.dtype) # a single buffer updated in place, starting at r0
+        buffer = np.empty(rt.shape[1], dtype=rt.dtype)
+        tx, ty, cx, cy = self.slice_splines(cache_dir)
+        tiles = self._tiles()
+        n_tiles = 1 if tiles is None else self.tiling.n_tiles
+        n = cx.shape[0]
+
+        for t in range(n_tiles):
+            for i in range(n):
+                progress(t*n+i, n_tiles*n)
+
+                gx = spline_from_coefficients(tx, ty, cx[i])
+                gy = spline_from_coefficients(tx, ty, cy[i])
+                if tiles is not None:
+                    gx, gy = tile_gradients(gx, gy, tiles[0], t, *tiles[1:])
+                advance_slice(rt, gx, gy, dz=dz, buffer=buffer)
             
-        self.rt = rt
+        self.rt = RayBuffer(rt, self.unit)
         
+    def solve_parallel(self, r0, processes=None, chunks=None, image=None, cache_dir=None):
+        """Trace rays through the turbulent grid using a pool of processes.
+        Rays are independent given the grid, so they are split into chunks and each worker advances its chunks
+        through all the slices. The cached spline coefficients are put in shared memory, not copied to each worker.
+
+        Args:
+            r0 (4xN float): array of N rays, in their initial configuration
+            processes (int, optional): number of worker processes. Defaults to None, one per core.
+            chunks (int, optional): number of ray chunks. Defaults to None, 4 per process.
+            image (detector.Detector, optional): if given, workers return partial images which are added to it,
+                and the final rays are not kept, so self.rt is None. Defaults to None.
+            cache_dir (str, optional): directory for an on-disk cache of the gradient splines. Defaults to None.
+        """
+        self.r0 = r0
+        dz = self.z[1]-self.z[0]
+        shared = [share_array(np.ascontiguousarray(a)) for a in self.slice_splines(cache_dir)]
+
+        processes = processes or os.cpu_count()
+        chunks = chunks or 4*processes
+        detector_args = None
+        if image is not None:
+            detector_args = (image.nx, image.ny, image.Lx, image.Ly, image.deposition)
+        work = [(r, detector_args) for r in np.array_split(ray_array(r0, self.unit, dtype=self.dtype), chunks, axis=1) if r.shape[1]]
+
+        try:
+            with Pool(processes, initializer=_init_worker, initargs=([spec for _, spec in shared], dz, self._tiles())) as pool:
+                results = pool.map(_trace_chunk, work)
+        finally:
+            for shm, _ in shared:
+                shm.close()
+                shm.unlink()
+
+        if image is None:
+            self.rt = RayBuffer(np.concatenate(results, axis=1), self.unit)
+        else:
+            self.rt = None # the rays of any earlier solve are not these
+            for H in results:
+                if H.dtype != image.H.dtype:
+                    image.H = image.H.astype(np.float64)
+                np.add(image.H, H, out=image.H, casting='unsafe')
+
+    def electron_cube(self, n_cr=1.21e21):
+        """Build a particle_tracker.ElectronCube holding the same density, for full 3D tracing.
+        The grid is converted from mm and cm^-3 to SI, and the laser wavelength is chosen to match n_cr.
+        The cube has the precision of the tracer, self.dtype. If the tracer has spectral gradients (self.grad_grid)
+        the cube uses them too, with d/dz found by finite differences if only the x and y gradients are known.
+        Assumes the grid is centred on z=0. The cube is kept, so it is only built once.
+
+        Args:
+            n_cr (float, optional): critical density in cm^-3, as used by the paraxial tracer. Defaults to 1.21e21.
+
+        Returns:
+            ElectronCube: cube with gradients calculated
+        """
+        if getattr(self, 'cube', None) is None:
+            import particle_tracker as pt
+            s = length_units[self.unit] # to m
+            self.cube = pt.ElectronCube(self.x*s, self.y*s, self.z*s, extent=self.z[-1]*s, dtype=self.dtype)
+            ne = np.stack([np.asarray(ne_slice) for ne_slice in self.ne_slices()]) # ne[z,y,x]
+            gradients = None
+            grad_grid = getattr(self, 'grad_grid', None)
+            if grad_grid is not None:
+                gz = grad_grid[2] if len(grad_grid) > 2 else np.gradient(ne, self.z, axis=0)
+                # [z,y,x] in cm^-3 mm^-1 to [x,y,z] in m^-4
+                gradients = [(g*(1e6/s)).transpose(2,1,0) for g in (grad_grid[0], grad_grid[1], gz)]
+            self.cube.external_ne(ne.transpose(2,1,0)*1e6, gradients) # ne[x,y,z], m^-3
+            omega = np.sqrt(n_cr*1e6/3.14207787e-4) # inverts nc in ElectronCube.calc_dndr
+            self.cube.calc_dndr(lwl=2*np.pi*pt.c/omega)
+        return self.cube
+
+    def solve_hybrid(self, r0, angle_threshold=1e-2, gradient_threshold=None, n_cr=1.21e21, cache_dir=None):
+        """Trace all rays paraxially, then re-trace only the strongly deflected ones with the full 3D solver.
+        Rays are escalated if their accumulated deflection exceeds angle_threshold, or if the largest density gradient
+        they met, normalised as |grad n_e|/n_cr, exceeds gradient_threshold. The re-traced rays replace their
+        paraxial counterparts in self.rt, so histograms include both populations.
+        self.escalated marks which rays were re-traced.
+
+        Args:
+            r0 (4xN float): array of N rays, in their initial configuration
+            angle_threshold (float, optional): deflection in radians above which rays are re-traced. Defaults to 1e-2.
+            gradient_threshold (float, optional): |grad n_e|/n_cr in mm^-1 above which rays are re-traced. Defaults to None, not used.
+            n_cr (float, optional): critical density in cm^-3. Defaults to 1.21e21.
+            cache_dir (str, optional): directory for an on-disk cache of the gradient splines. Defaults to None.
+        """
+        if self.tiling is not None:
+            raise ValueError("solve_hybrid does not trace tiled grids, use solve or solve_parallel")
+        self.r0 = r0
+        dz = self.z[1]-self.z[0]
+
+        r0 = ray_array(r0, self.unit, dtype=self.dtype)
+        rt = r0.copy()
+        buffer = np.empty(rt.shape[1], dtype=rt.dtype)
+        max_grad = np.zeros(rt.shape[1])
+        tx, ty, cx, cy = self.slice_splines(cache_dir)
+        for i in range(cx.shape[0]):
+            gx = spline_from_coefficients(tx, ty, cx[i])
+            gy = spline_from_coefficients(tx, ty, cy[i])
+            advance_slice(rt, gx, gy, dz=dz, n_cr=n_cr, buffer=buffer, max_grad=max_grad)
+
+        deflection = np.hypot(rt[1]-r0[1], rt[3]-r0[3])
+        escalate = deflection > angle_threshold
+        if gradient_threshold is not None:
+            escalate |= max_grad/n_cr > gradient_threshold
+        self.escalated = escalate
+
+        if escalate.any():
+            rt[:, escalate] = self._solve_3D(r0[:, escalate], n_cr)
+        self.rt = RayBuffer(rt, self.unit)
+
+    def _solve_3D(self, r0, n_cr):
+        """Trace paraxial rays (in self.unit, radians) with the full 3D solver, returning them at the paraxial exit plane"""
+        import particle_tracker as pt
+        cube = self.electron_cube(n_cr)
+        s = length_units[self.unit] # to m
+        Np = r0.shape[1]
+
+        # paraxial angles are slopes dx/dz, dy/dz
+        tx, ty = np.tan(r0[1]), np.tan(r0[3])
+        norm = np.sqrt(1+tx**2+ty**2)
+        s0 = np.zeros((9,Np))
+        s0[0], s0[1], s0[2] = r0[0]*s, r0[2]*s, self.z[0]*s
+        s0[3], s0[4], s0[5] = pt.c*tx/norm, pt.c*ty/norm, pt.c/norm
+        s0[6] = 1.0 # amplitude
+
+        rf = cube.solve(s0, verbose=False).to(self.unit) # at z = z[-1], angles arctan(v_x/v_z)
+        r = np.empty((4,Np))
+        r[1], r[3] = np.tan(rf[1]), np.tan(rf[3])
+        dz = self.z[1]-self.z[0] # the paraxial trace ends a step beyond the last slice
+        r[0] = rf[0]+dz*r[1]
+        r[2] = rf[2]+dz*r[3]
+        return r
+
+    def solve_screens(self, r0, K=1, cache_dir=None):
+        """Approximate the slice by slice trace with K thin phase screens, for weak deflections.
+        The slices are split into K groups of consecutive slices. The gradient of each group is integrated along z
+        into one screen at the centre of the group, with free space propagation between screens.
+        K=1 is the classic thin screen limit, K=2N+1 is the full trace. See screen_error for the accuracy.
+
+        Because a spline is linear in its coefficients, the integrated gradient spline of a screen is
+        simply the sum of the cached slice coefficients.
+
+        Args:
+            r0 (4xN float): array of N rays, in their initial configuration
+            K (int, optional): number of screens. Defaults to 1.
+            cache_dir (str, optional): directory for an on-disk cache of the gradient splines. Defaults to None.
+        """
+        if self.tiling is not None:
+            raise ValueError("solve_screens does not trace tiled grids, use solve or solve_parallel")
+        self.r0 = r0
+        dz = self.z[1]-self.z[0]
+        tx, ty, cx, cy = self.slice_splines(cache_dir)
+
+        rt = ray_array(r0, self.unit, dtype=self.dtype)
+        z = self.z[0] # the full trace starts at the first slice...
+        for group in np.array_split(np.arange(cx.shape[0]), K):
+            z_s = self.z[group].mean()
+            rt = transform(distance_matrix(z_s-z), rt)
+            gx = spline_from_coefficients(tx, ty, cx[group].sum(axis=0))
+            gy = spline_from_coefficients(tx, ty, cy[group].sum(axis=0))
+            rt = deflect_rays(rt, gx, gy, dz=dz)
+            z = z_s
+        self.rt = RayBuffer(transform(distance_matrix(self.z[-1]+dz-z), rt), self.unit) # ...and ends a step beyond the last
+
+    def screen_error(self, r0, K=1, cache_dir=None):
+        """Compare the thin screen approximation with the full slice by slice trace.
+
+        Args:
+            r0 (4xN float): array of N rays, in their initial configuration
+            K (int, optional): number of screens. Defaults to 1.
+            cache_dir (str, optional): directory for an on-disk cache of the gradient splines. Defaults to None.
+
+        Returns:
+            dict: rms and max difference in position (x, y) and angle (theta, phi) between the two traces
+        """
+        self.solve(r0, cache_dir=cache_dir)
+        rt_full = self.rt
+        self.solve_screens(r0, K=K, cache_dir=cache_dir)
+        d = self.rt-rt_full
+        self.rt = rt_full
+
+        pos = np.sqrt(d[0]**2+d[2]**2)
+        ang = np.sqrt(d[1]**2+d[3]**2)
+        return dict(position_rms=np.sqrt(np.nanmean(pos**2)), position_max=np.nanmax(pos),
+                    angle_rms=np.sqrt(np.nanmean(ang**2)), angle_max=np.nanmax(ang))
+
     def plot_rays(self, clim=None):
-        H0, xedges0, yedges0 = histogram(self.r0, bin_scale=10, pix_x=1000, pix_y=1000, Lx=10,Ly=10)
+        H0, xedges0, yedges0 = histogram(ray_array(self.r0, self.unit), bin_scale=10, pix_x=1000, pix_y=1000, Lx=10,Ly=10)
         Hf, xedgesf, yedgesf = histogram(self.rt, bin_scale=10, pix_x=1000, pix_y=1000, Lx=10,Ly=10)
         
+        import matplotlib.pyplot as plt
         fig,(ax1,ax2)=plt.subplots(1,2,figsize=(8,4))
         
         plot_histogram(H0, xedges0,yedges0, ax1, clim=clim)
         plot_histogram(Hf, xedgesf,yedgesf, ax2, clim=clim)
 
 
+class StreamedGrid(GridTracer):
+    """Trace rays through a density grid which is streamed a slice at a time, eg. one too large for memory.
+    The gradient splines of each slice are fitted on a background thread while the previous slice is traced,
+    and are not cached, so memory use is a few slices regardless of the grid size.
+    The cached methods (solve_screens, solve_parallel) still work, but keep the coefficients of every slice in memory.
+    """
+    def __init__(self, source, x, y, z, depth=2):
+        """
+        Args:
+            source (iterable): slices ne[y,x] in order of z, eg. grid_source.MemmapSlices or GeneratorSlices
+            x (M float array): x coordinates
+            y (N float array): y coordinates
+            z (float array): z coordinates of the slices, evenly spaced
+            depth (int, optional): number of slices prepared ahead of the tracer. Defaults to 2.
+        """
+        self.source, self.x, self.y, self.z, self.depth = source, x, y, z, depth
+
+    def ne_slices(self):
+        return self.source
+
+    def solve(self, r0, cache_dir=None, progress=no_progress):
+        """Trace rays through the streamed grid
+
+        Args:
+            r0 (4xN float): array of N rays, in their initial configuration
+            cache_dir (str, optional): not used, streamed splines are not cached. Kept so the inherited methods,
+                eg. screen_error, can call solve as on any GridTracer. Defaults to None.
+            progress (function, optional): called as progress(i, n) at each slice. Defaults to no_progress.
+        """
+        self.r0 = r0
+        dz = self.z[1]-self.z[0]
+
+        rt = ray_array(r0, self.unit, dtype=self.dtype)
+        buffer = np.empty(rt.shape[1], dtype=rt.dtype)
+        tiles = self._tiles()
+        n_tiles = 1 if tiles is None else self.tiling.n_tiles
+        n = len(self.z)
+
+        for t in range(n_tiles): # the source is streamed again for each tile
+            for i, (gx, gy) in enumerate(prefetch(self.source, depth=self.depth, transform=self.fit_slice)):
+                progress(t*n+i, n_tiles*n)
+                if tiles is not None:
+                    gx, gy = tile_gradients(gx, gy, tiles[0], t, *tiles[1:])
+                advance_slice(rt, gx, gy, dz=dz, buffer=buffer)
+
+        self.rt = RayBuffer(rt, self.unit)
+
 class TurbulentGrid(GridTracer):
     """Trace rays through a turbulent electron density defined on a grid
     """
-    def __init__(self, N, spectrum, n_e0, dn_e, scale):
+    def __init__(self, N, spectrum, n_e0, dn_e, scale, spectral_gradients=False, dtype=np.float64):
         """generate a turbulent grid.
 
         You can use cm^-3 for density and mm for scales.
@@ -227,13 +774,53 @@ class TurbulentGrid(GridTracer):
             n_e0 (float): mean electron density
             dn_e (float): standard deviation of electron density
             scale (float): length of a box side. 
+            spectral_gradients (bool, optional): generate the density with gaussian3D_rFFT, along with its exact
+                spectral x, y and z gradients in self.grad_grid, which are used instead of finite differences. Defaults to False.
+            dtype (numpy dtype, optional): float64, or float32 to halve the memory of the grid, gradients and rays,
+                see GridTracer. Defaults to float64.
         """
+        self.dtype = np.dtype(dtype)
         self.N=N
         self.scale=scale
         self.x = np.linspace(-scale,scale,2*N+1)
         self.y = self.x
         self.z = self.x
         
-        s3 = gaussian3D_FFT(N, spectrum)
-        self.ne_grid = n_e0 + dn_e*s3/s3.std()
+        if spectral_gradients:
+            dx = self.x[1]-self.x[0]
+            s3, (ds3_dz, ds3_dy, ds3_dx) = gaussian3D_rFFT(N, spectrum, gradient=True, spacing=dx, dtype=self.dtype) # indexed [z,y,x]
+            norm = dn_e/s3.std()
+            self.ne_grid = n_e0 + norm*s3
+            self.grad_grid = norm*ds3_dx, norm*ds3_dy, norm*ds3_dz
+        else:
+            s3 = gaussian3D_FFT(N, spectrum).astype(self.dtype, copy=False)
+            self.ne_grid = n_e0 + dn_e*s3/s3.std()
     
+
+def turbulent_screen(N, spectrum, n_e0, dn_e, scale, n_cr=1.21e21, rng=None):
+    """Thin screen preview of a TurbulentGrid with the same parameters, without making the 3D grid.
+    The z-integral of the density and its gradients come from the k_z=0 plane of the spectrum (gaussian3D_projected),
+    at O(N^2 log N) cost. The density is normalised by the expected standard deviation of the 3D field,
+    rather than that of one realisation as in TurbulentGrid.
+
+    Args:
+        N (int): half size of cube, will be 2*N+1
+        spectrum (function of k): a spectrum, such as k**-11/3
+        n_e0 (float): mean electron density, cm^-3
+        dn_e (float): standard deviation of electron density, cm^-3
+        scale (float): half length of a box side, mm
+        n_cr (float, optional): critical density, cm^-3. Defaults to 1.21e21.
+        rng (numpy Generator or int, optional): random number generator, or a seed for one. Defaults to None.
+
+    Returns:
+        x, y, column, theta, phi: coordinates (mm), line integrated density [y,x] (cm^-3 mm),
+            and the x and y deflections [y,x] of rays crossing the screen (radians)
+    """
+    x = np.linspace(-scale,scale,2*N+1)
+    dx = x[1]-x[0]
+    col, (dcol_dy, dcol_dx) = gaussian3D_projected(N, spectrum, rng=rng, spacing=dx)
+    norm = dn_e/np.sqrt(gaussianND_variance((2*N+1,)*3, spectrum))
+    column = n_e0*(2*N+1)*dx + norm*col # the tracer crosses 2N+1 slices of thickness dx
+    theta = -norm*dcol_dx/(2*n_cr)
+    phi = -norm*dcol_dy/(2*n_cr)
+    return x, x, column, theta, phi
@@ -86,7 +86,10 @@ import numpy as np
 from scipy.integrate import odeint,solve_ivp
 from scipy.interpolate import RegularGridInterpolator
 from time import time
+import hashlib
 import scipy.constants as sc
+from optics import RayBuffer
+from tiling import Tiling, periodic_pad, periodic_gradient, grid_period
 
 c = sc.c # honestly, this could be 3e8 *shrugs*
 
@@ -94,7 +97,7 @@ class ElectronCube:
     """A class to hold and generate electron density cubes
     """
     
-    def __init__(self, x, y, z, extent, B_on = False):
+    def __init__(self, x, y, z, extent, B_on = False, dtype = np.float64):
         """
         Example:
             N_V = 100
@@ -109,11 +112,70 @@ class ElectronCube:
             y (float array): y coordinates, m
             z (float array): z coordinates, m
             extent (float): physical size, m
+            dtype (numpy dtype, optional): float64, or float32 to halve the memory of the density, gradient and
+                B grids and of the returned rays. The ray equations are still integrated in float64. Defaults to float64.
         """
         self.z,self.y,self.x = z, y, x
         self.XX, self.YY, self.ZZ = np.meshgrid(x,y,z, indexing='ij')
         self.extent = extent
         self.B_on = B_on
+        self.dtype = np.dtype(dtype)
+        self.ne_field = None
+        self.tiling = None
+
+    def tile(self, n_tiles, shifts=False, reflections=False, rng=None, period=None):
+        """Repeat the cube periodically, see tiling.py. Call before calc_dndr.
+        The plasma then runs from z[0] to z[0]+n_tiles*period_z, and is periodic in x and y, so rays which leave
+        through the sides re-enter on the other side. Rays are traced until they leave the last tile,
+        and solve returns them at that plane. The density should be periodic, eg. from the FFT generators in turboGen.
+
+        Args:
+            n_tiles (int): number of cubes along z
+            shifts (bool, optional): shift each tile by a random fraction of the period in x and y. Defaults to False.
+            reflections (bool, optional): reflect each tile in x and/or y at random. Defaults to False.
+            rng (numpy Generator or int, optional): random number generator, or a seed for one. Defaults to None.
+            period (3 float, optional): period in x, y and z, m. Defaults to None: for a grid, the number of points
+                times the spacing; for a field_ne, the span of x, y and z.
+        """
+        if period is None:
+            if self.ne_field is not None:
+                period = [a[-1]-a[0] for a in (self.x, self.y, self.z)]
+            else:
+                period = [grid_period(a) for a in (self.x, self.y, self.z)]
+        self.period = np.asarray(period, dtype=float)
+        self.tiling = Tiling(n_tiles, shifts, reflections, rng)
+
+    def exit_plane(self):
+        """z at which rays leave the plasma: the far side of the cube, or of the last tile"""
+        if self.tiling is None:
+            return self.extent
+        return self.z[0]+self.tiling.n_tiles*self.period[2]
+
+    def _local(self, x):
+        """Map locations x (3xN) in the tiled plasma into the cube.
+
+        Returns:
+            3xN float, 2xN float, N bool: locations in the cube, the sign of the x and y gradients there,
+                and which locations are in the plasma
+        """
+        x0, y0, z0 = self.x[0], self.y[0], self.z[0]
+        i = np.floor((x[2]-z0)/self.period[2]).astype(int)
+        inside = (i >= 0) & (i < self.tiling.n_tiles)
+        i = np.clip(i, 0, self.tiling.n_tiles-1)
+        xl = np.empty_like(x)
+        sign = np.empty((2, x.shape[1]))
+        xl[0], sign[0] = self.tiling.local(i, x[0], 0, x0, self.period[0])
+        xl[1], sign[1] = self.tiling.local(i, x[1], 1, y0, self.period[1])
+        xl[2] = x[2]-i*self.period[2]
+        return xl, sign, inside
+
+    def _interpolator(self, values):
+        """Linear interpolator of values on the grid, zero outside. If tiled, the grid is padded to a whole period."""
+        axes = (self.x, self.y, self.z)
+        if self.tiling is not None:
+            axes = [np.append(a, a[0]+p) for a, p in zip(axes, self.period)]
+            values = periodic_pad(values, (0, 1, 2))
+        return RegularGridInterpolator(axes, values, bounds_error = False, fill_value = 0.0)
         
     def test_null(self):
         """
@@ -154,13 +216,32 @@ class ElectronCube:
         """
         self.ne = n_e0*10**(self.XX/s)*(1+np.cos(2*np.pi*self.YY/Ly))
         
-    def external_ne(self, ne):
+    def external_ne(self, ne, gradients=None):
         """Load externally generated grid
 
         Args:
             ne ([type]): MxMxM grid of density in m^-3
+            gradients (3 MxMxM arrays, optional): d(ne)/dx, d(ne)/dy, d(ne)/dz in m^-4, indexed [x,y,z] as ne,
+                eg. exact spectral derivatives from turboGen.gaussian3D_rFFT(..., gradient=True).
+                calc_dndr then uses them instead of finite differences. Defaults to None.
         """
         self.ne = ne
+        self.ne_gradients = gradients
+        self.ne_field = None
+
+    def field_ne(self, field):
+        """Use an analytic density in place of the grid, eg. a turboGen.ModeField in m and m^-3.
+        The density and its exact gradient are evaluated at the ray positions, so there is no gradient grid
+        and no interpolation error. x, y and z then only need to span the cube, eg. np.linspace(-extent, extent, 2).
+        Outside the cube the density is zero, as for a grid.
+
+        Any object with evaluate(x, y, z, gradient=False), returning n_e (and its 3xN gradient), and key(),
+        returning a string which identifies the field, can be used.
+
+        Args:
+            field (ModeField): density in m^-3
+        """
+        self.ne_field = field
         
     def test_B(self, Bmax=1.0):
         """A Bz field with a linear gradient in x:
@@ -181,30 +262,51 @@ class ElectronCube:
 
         omega = 2*np.pi*(c/lwl)
         nc = 3.14207787e-4*omega**2
+        self.lwl = lwl
+        self.nc = nc
 
         # Find Faraday rotation constant http://farside.ph.utexas.edu/teaching/em/lectures/node101.html
         if (self.B_on):
             self.VerdetConst = 2.62e-13*lwl**2 # radians per Tesla per m^2
 
-        self.ne_nc = self.ne/nc #normalise to critical density
+        if self.ne_field is not None: # gradients are found analytically in dndr
+            self.ne_hash = self.ne_field.key()
+            return
+
+        # Fingerprint the density now, it may be cleared from memory before tracing
+        self.ne_hash = hashlib.sha1(np.ascontiguousarray(self.ne)).hexdigest()
+
+        self.ne_nc = np.divide(self.ne, nc, dtype=self.dtype) #normalise to critical density
         
-        #More compact notation is possible here, but we are explicit
-        self.dndx = -0.5*c**2*np.gradient(self.ne_nc,self.x,axis=0)
-        self.dndy = -0.5*c**2*np.gradient(self.ne_nc,self.y,axis=1)
-        self.dndz = -0.5*c**2*np.gradient(self.ne_nc,self.z,axis=2)
+        if getattr(self, 'ne_gradients', None) is not None: # precomputed, eg. spectrally
+            gx, gy, gz = self.ne_gradients
+            self.dndx = -0.5*c**2*(gx/nc)
+            self.dndy = -0.5*c**2*(gy/nc)
+            self.dndz = -0.5*c**2*(gz/nc)
+        elif self.tiling is not None: # differences wrap around the periodic grid
+            self.dndx = -0.5*c**2*periodic_gradient(self.ne_nc,self.x[1]-self.x[0],axis=0)
+            self.dndy = -0.5*c**2*periodic_gradient(self.ne_nc,self.y[1]-self.y[0],axis=1)
+            self.dndz = -0.5*c**2*periodic_gradient(self.ne_nc,self.z[1]-self.z[0],axis=2)
+        else:
+            #More compact notation is possible here, but we are explicit
+            self.dndx = -0.5*c**2*np.gradient(self.ne_nc,self.x,axis=0)
+            self.dndy = -0.5*c**2*np.gradient(self.ne_nc,self.y,axis=1)
+            self.dndz = -0.5*c**2*np.gradient(self.ne_nc,self.z,axis=2)
+        self.dndx, self.dndy, self.dndz = (g.astype(self.dtype, copy=False) for g in (self.dndx, self.dndy, self.dndz))
         
-        self.dndx_interp = RegularGridInterpolator((self.x, self.y, self.z), self.dndx, bounds_error = False, fill_value = 0.0)
-        self.dndy_interp = RegularGridInterpolator((self.x, self.y, self.z), self.dndy, bounds_error = False, fill_value = 0.0)
-        self.dndz_interp = RegularGridInterpolator((self.x, self.y, self.z), self.dndz, bounds_error = False, fill_value = 0.0)
+        self.dndx_interp = self._interpolator(self.dndx)
+        self.dndy_interp = self._interpolator(self.dndy)
+        self.dndz_interp = self._interpolator(self.dndz)
 
     def set_up_interps(self):
         # Electron density
-        self.ne_interp = RegularGridInterpolator((self.x, self.y, self.z), self.ne, bounds_error = False, fill_value = 0.0)
+        if self.ne_field is None:
+            self.ne_interp = self._interpolator(self.ne.astype(self.dtype, copy=False))
         # Magnetic field
         if(self.B_on):
-            self.Bx_interp = RegularGridInterpolator((self.x, self.y, self.z), self.B[:,:,:,0], bounds_error = False, fill_value = 0.0)
-            self.By_interp = RegularGridInterpolator((self.x, self.y, self.z), self.B[:,:,:,1], bounds_error = False, fill_value = 0.0)
-            self.Bz_interp = RegularGridInterpolator((self.x, self.y, self.z), self.B[:,:,:,2], bounds_error = False, fill_value = 0.0)
+            self.Bx_interp = self._interpolator(self.B[:,:,:,0].astype(self.dtype))
+            self.By_interp = self._interpolator(self.B[:,:,:,1].astype(self.dtype))
+            self.Bz_interp = self._interpolator(self.B[:,:,:,2].astype(self.dtype))
 
     def plot_midline_gradients(self,ax,probing_direction):
         """I actually don't know what this does. Presumably plots the gradients half way through the box? Cool.
@@ -240,16 +342,58 @@ class ElectronCube:
         Returns:
             3 x N float: N [dx,dy,dz] electron density gradients
         """
+        if self.tiling is not None:
+            xl, sign, inside = self._local(x)
+            xl = xl[:,inside]
+            grad = np.zeros_like(x)
+            if self.ne_field is not None:
+                _, dne = self.ne_field.evaluate(*xl, gradient=True)
+                grad[:,inside] = -0.5*c**2*dne/self.nc
+            else:
+                grad[:,inside] = [self.dndx_interp(xl.T), self.dndy_interp(xl.T), self.dndz_interp(xl.T)]
+            grad[:2] *= sign # reflected tiles reverse the gradient
+            return grad
+
+        if self.ne_field is not None:
+            grad = np.zeros_like(x)
+            inside = self.inside(x)
+            _, dne = self.ne_field.evaluate(*x[:,inside], gradient=True)
+            grad[:,inside] = -0.5*c**2*dne/self.nc
+            return grad
+
         grad = np.zeros_like(x)
         grad[0,:] = self.dndx_interp(x.T)
         grad[1,:] = self.dndy_interp(x.T)
         grad[2,:] = self.dndz_interp(x.T)
         return grad
 
+    def inside(self, x):
+        """Which of the locations x (3xN) are inside the cube, or the tiled plasma"""
+        if self.tiling is not None:
+            return self._local(x)[2]
+        return ((x[0] >= self.x[0]) & (x[0] <= self.x[-1]) & (x[1] >= self.y[0]) & (x[1] <= self.y[-1])
+                & (x[2] >= self.z[0]) & (x[2] <= self.z[-1]))
+
     def get_ne(self,x):
+        if self.tiling is not None:
+            xl, _, inside = self._local(x)
+            ne = np.zeros(x.shape[1])
+            ne[inside] = self.ne_field.evaluate(*xl[:,inside]) if self.ne_field is not None else self.ne_interp(xl[:,inside].T)
+            return ne
+        if self.ne_field is not None:
+            ne = np.zeros(x.shape[1])
+            inside = self.inside(x)
+            ne[inside] = self.ne_field.evaluate(*x[:,inside])
+            return ne
         return self.ne_interp(x.T)
 
     def get_B(self,x):
+        if self.tiling is not None:
+            xl, _, inside = self._local(x)
+            B = np.zeros((3, x.shape[1]))
+            xl = xl[:,inside].T
+            B[:,inside] = [self.Bx_interp(xl),self.By_interp(xl),self.Bz_interp(xl)]
+            return B
         B = np.array([self.Bx_interp(x.T),self.By_interp(x.T),self.Bz_interp(x.T)])
         return B
 
@@ -272,12 +416,34 @@ class ElectronCube:
 
         return pol
 
-    def solve(self, s0):
+    def provenance(self):
+        """Describe this cube, so stored rays can be matched to it. Call after calc_dndr.
+
+        Returns:
+            dict: JSON serialisable description of the density and grid
+        """
+        shape = None if self.ne_field is not None else list(self.dndx_interp.values.shape)
+        return dict(ne_sha1=self.ne_hash, shape=shape, extent=self.extent,
+                    x=[float(self.x[0]), float(self.x[-1])], y=[float(self.y[0]), float(self.y[-1])],
+                    z=[float(self.z[0]), float(self.z[-1])], lwl=self.lwl, B_on=self.B_on, dtype=self.dtype.name,
+                    tiling=None if self.tiling is None else dict(self.tiling.describe(), period=self.period.tolist()))
+
+    def solve(self, s0, store=None, verbose=True):
+        """Trace rays through the cube
+
+        Args:
+            s0 (9xN float): N rays, see init_beam
+            store (ray_store.RayStore, optional): if given, the final rays are appended to the store. Defaults to None.
+            verbose (bool, optional): print the time taken. Defaults to True.
+
+        Returns:
+            RayBuffer: N rays in m, [x, theta, y, phi] at the exit of the cube, or of the last tile
+        """
         # Need to make sure all rays have left volume
         # Conservative estimate of diagonal across volume
         # Then can backproject to surface of volume
 
-        t  = np.linspace(0.0,np.sqrt(8.0)*self.extent/c,2)
+        t  = np.linspace(0.0,np.sqrt(2.0)*(self.exit_plane()+self.extent)/c,2)
 
         s0 = s0.flatten() #odeint insists
 
@@ -285,11 +451,16 @@ class ElectronCube:
         dsdt_ODE = lambda t, y: dsdt(t, y, self)
         sol = solve_ivp(dsdt_ODE, [0,t[-1]], s0, t_eval=t)
         finish = time()
-        print("Ray trace completed in:\t",finish-start,"s")
+        if verbose:
+            print("Ray trace completed in:\t",finish-start,"s")
 
         Np = s0.size//9
         self.sf = sol.y[:,-1].reshape(9,Np)
-        self.rf,self.Jf = ray_to_Jonesvector(self.sf, self.extent)
+        self.rf,self.Jf = ray_to_Jonesvector(self.sf, self.exit_plane())
+        self.rf = RayBuffer(self.rf.astype(self.dtype, copy=False), 'm')
+        self.Jf = self.Jf.astype(np.result_type(self.dtype, np.complex64), copy=False)
+        if store is not None:
+            store.append(self.rf, self.Jf)
         return self.rf
 
     def clear_memory(self):
@@ -418,7 +589,7 @@ def ray_to_Jonesvector(ode_sol, ne_extent, probing_direction = 'z'):
     """
     Np = ode_sol.shape[1] # number of photons
     ray_p = np.zeros((4,Np))
-    ray_J = np.zeros((2,Np),dtype=np.complex)
+    ray_J = np.zeros((2,Np),dtype=np.complex128)
 
     x, y, z, vx, vy, vz = ode_sol[0], ode_sol[1], ode_sol[2], ode_sol[3], ode_sol[4], ode_sol[5]
 
@@ -465,3 +636,47 @@ def ray_to_Jonesvector(ode_sol, ne_extent, probing_direction = 'z'):
     return ray_p,ray_J
 
 
+
+def slab_precision_report(dtype=np.float32, Np=10000, N_V=50, s=1, n_e0=2e23, extent=5e-3, lwl=1053e-9):
+    """Validate a reduced precision ElectronCube against float64 and the analytic deflection of test_slab.
+    A ray crossing the slab, a length 2*extent, is deflected by theta = -s*n_e0/n_c in x.
+    The error against theta is set by the integrator's steps across the faces of the cube and is the same in
+    both precisions, so error_vs_float64 is the measure of the reduced precision.
+
+    Args:
+        dtype (numpy dtype, optional): precision to validate. Defaults to float32.
+        Np (int, optional): number of rays. Defaults to 10000.
+        N_V (int, optional): cube has 2*N_V+1 points per side. Defaults to 50.
+        s (float, optional): slab gradient, see test_slab. Defaults to 1.
+        n_e0 (float, optional): mean density, m^-3. Defaults to 2e23.
+        extent (float, optional): half size of the cube, m. Defaults to 5e-3.
+        lwl (float, optional): laser wavelength, m. Defaults to 1053e-9.
+
+    Returns:
+        dict: analytic and mean deflections in each precision (rad), their relative errors and relative difference,
+            the largest differences in position (m) and angle (rad) between the precisions,
+            and the memory of the gradient grids (bytes)
+    """
+    M_V = 2*N_V+1
+    ne_x = np.linspace(-extent,extent,M_V)
+    s0 = init_beam(Np = Np, beam_size=0.5*extent, divergence = 0, ne_extent = extent)
+
+    rays, grid_bytes = {}, {}
+    for d in (np.float64, dtype):
+        slab = ElectronCube(ne_x,ne_x,ne_x,extent, dtype=d)
+        slab.test_slab(s=s, n_e0=n_e0)
+        slab.calc_dndr(lwl)
+        rays[np.dtype(d).name] = slab.solve(s0, verbose=False)
+        grid_bytes[np.dtype(d).name] = slab.dndx.nbytes+slab.dndy.nbytes+slab.dndz.nbytes
+    r64, r = rays['float64'], rays[np.dtype(dtype).name]
+
+    theta = -s*n_e0/slab.nc
+    report = dict(dtype=np.dtype(dtype).name, theta_analytic=theta,
+                  theta_float64=float(r64[1].mean()), theta_dtype=float(r[1].mean()),
+                  error_float64=float(r64[1].mean()/theta-1), error_dtype=float(r[1].mean()/theta-1),
+                  error_vs_float64=float(r[1].mean()/r64[1].mean()-1),
+                  position_max=float(np.abs(r[0:4:2]-r64[0:4:2]).max()), angle_max=float(np.abs(r[1:4:2]-r64[1:4:2]).max()),
+                  grid_bytes_float64=grid_bytes['float64'], grid_bytes_dtype=grid_bytes[np.dtype(dtype).name])
+    for k, v in report.items():
+        print(k+":\t", v)
+    return report
@@ -1,16 +1,22 @@
 """
 Example code for plotting data produced by hpc runs
 
+Results are opened memory mapped, without importing the ray tracing code.
+Pickles from older runs can be converted once with:
+
+from result_file import convert_pickles
+convert_pickles({'Schlieren': './Schlieren.pkl', 'Shadowgraphy': './Shadowgraphy.pkl', 'Burdiscope': './Burdiscope.pkl'}, './')
+
 """
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pickle
-import ray_transfer_matrix as rtm
+from result_file import open_results
 
-sc = pickle.load( open( "./Schlieren.pkl", "rb" ) )
-sh = pickle.load( open( "./Shadowgraphy.pkl", "rb" ) )
-b  = pickle.load( open( "./Burdiscope.pkl", "rb" ) )
+r  = open_results("./")
+sc = r['Schlieren']
+sh = r['Shadowgraphy']
+b  = r['Burdiscope']
 
 print("Number of rays at Burdiscope: %d"%(int(np.sum(b.H))))
 
@@ -0,0 +1,137 @@
+"""
+A chunked, on-disk store for traced rays, so a trace can be imaged many times.
+
+Tracing through an ElectronCube is expensive, but its 4xN output rf is cheap to keep.
+Each call to append writes one chunk as a .npy file, which is memory mapped when read back,
+so a store larger than RAM can be replayed through the ray transfer matrix diagnostics a bundle at a time.
+
+The store records the provenance of the rays (eg. the cube fingerprint and beam parameters) in meta.json.
+Opening an existing store with a different provenance raises an error, so stale rays are never reused.
+
+Example:
+    store = RayStore('./rays_sin/', dtype=np.float32, jones=True,
+                     provenance=dict(cube=sin.provenance(), beam=dict(beam_size=5e-3, divergence=0.05e-3)))
+    for i in range(10):
+        s0 = pt.init_beam(Np=int(1e6), beam_size=5e-3, divergence=0.05e-3, ne_extent=ne_extent)
+        sin.solve(s0, store=store)
+
+    sc = rtm.SchlierenRays(None)
+    sc.replay(store, bin_scale=10)
+"""
+
+import numpy as np
+import json
+import hashlib
+import os
+from optics import RayBuffer, unit_of, unit_scale
+
+def provenance_key(provenance):
+    """A short, stable key for a provenance dictionary, eg. for naming a store directory.
+
+    Args:
+        provenance (dict): JSON serialisable description of how the rays were made
+
+    Returns:
+        str: hex digest
+    """
+    return hashlib.sha1(json.dumps(provenance, sort_keys=True).encode()).hexdigest()[:16]
+
+class RayStore:
+    """A directory of ray chunks, rays_00000.npy, rays_00001.npy... with optional Jones vectors jones_00000.npy...
+    """
+    def __init__(self, path, dtype=np.float64, jones=False, provenance=None, unit='m'):
+        """Open a store, creating it if it does not exist.
+        When opening an existing store, dtype, jones and unit are read from disk.
+
+        Args:
+            path (str): directory holding the store
+            dtype (numpy dtype, optional): storage precision of the rays, np.float32 halves the size. Defaults to np.float64.
+            jones (bool, optional): also store the Jones vectors. Defaults to False.
+            provenance (dict, optional): JSON serialisable description of the cube and beam. Defaults to None.
+            unit (str, optional): length unit of the stored rays, as from ElectronCube.solve. Defaults to 'm'.
+        """
+        self.path = path
+        self.meta_file = os.path.join(path, 'meta.json')
+
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as f:
+                self.meta = json.load(f)
+            if provenance is not None and not self.matches(provenance):
+                raise ValueError("Ray store at %s was made with a different provenance"%path)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.meta = dict(dtype=np.dtype(dtype).name, jones=jones, unit=unit, provenance=provenance, chunks=[])
+            self._write_meta()
+
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.jones = self.meta['jones']
+        self.unit = self.meta.get('unit', 'm') # older stores were always written from ElectronCube
+
+    def _write_meta(self):
+        with open(self.meta_file, 'w') as f:
+            json.dump(self.meta, f, indent=1)
+
+    def _chunk_file(self, kind, i):
+        return os.path.join(self.path, "%s_%05d.npy"%(kind, i))
+
+    @property
+    def provenance(self):
+        return self.meta['provenance']
+
+    @property
+    def Np(self):
+        """Total number of rays in the store"""
+        return sum(self.meta['chunks'])
+
+    def matches(self, provenance):
+        """Check whether the rays in this store were made with the given provenance.
+
+        Args:
+            provenance (dict): JSON serialisable description of the cube and beam
+
+        Returns:
+            bool: True if they match
+        """
+        return provenance_key(self.meta['provenance']) == provenance_key(provenance)
+
+    def append(self, rf, Jf=None):
+        """Write a chunk of rays.
+
+        Args:
+            rf (4xN float): N rays, [x, theta, y, phi]. A RayBuffer in another unit is converted, plain arrays are assumed to be in self.unit.
+            Jf (2xN complex, optional): Jones vectors, [E_x, E_y]. Required if the store keeps Jones vectors.
+        """
+        i = len(self.meta['chunks'])
+        rays = np.asarray(rf, dtype=self.dtype)
+        if self.jones: # checked before anything is written, so a bad call leaves no chunk on disk
+            if Jf is None:
+                raise ValueError("this store keeps Jones vectors, append needs Jf")
+            cdtype = np.result_type(self.dtype, np.complex64)
+            jones = np.asarray(Jf, dtype=cdtype)
+            if jones.shape != (2, rays.shape[1]):
+                raise ValueError("Jf must have shape (2, %d), got %s"%(rays.shape[1], jones.shape))
+        s = unit_scale(unit_of(rf, self.unit), self.unit)
+        if s != 1:
+            rays = rays*np.array([s, 1, s, 1], dtype=self.dtype)[:,None]
+        np.save(self._chunk_file('rays', i), rays)
+        if self.jones:
+            np.save(self._chunk_file('jones', i), jones)
+
+        self.meta['chunks'].append(int(rf.shape[1]))
+        self._write_meta()
+
+    def chunks(self, max_rays=None):
+        """Iterate over the stored rays, memory mapped, so only the rays in use are read from disk.
+
+        Args:
+            max_rays (int, optional): split chunks so no more than this many rays are yielded at once. Defaults to None.
+
+        Yields:
+            RayBuffer, 2xN complex or None: rays and Jones vectors
+        """
+        for i, n in enumerate(self.meta['chunks']):
+            rays = np.load(self._chunk_file('rays', i), mmap_mode='r')
+            jones = np.load(self._chunk_file('jones', i), mmap_mode='r') if self.jones else None
+            step = n if max_rays is None else int(max_rays)
+            for j in range(0, n, max(step, 1)):
+                yield RayBuffer(rays[:, j:j+step], self.unit), None if jones is None else jones[:, j:j+step]
@@ -1,6 +1,8 @@
 import sympy as sym
 import numpy as np
 import matplotlib.pyplot as plt
+from detector import Detector, cameras, plot_histogram
+from optics import RayBuffer, unit_of, unit_scale, transform, lens, sym_lens, distance, ray
 
 '''
 Example:
@@ -92,12 +94,6 @@ for ax in axs:
 fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0.1, hspace=None)
 '''
 
-def transform(matrix, rays):
-    '''
-    Simple wrapper for matrix multiplication
-    '''
-    return np.matmul(matrix,rays)
-
 def circular_aperture(R, rays):
     '''
     Filters rays to find those inside a radius R
@@ -116,59 +112,19 @@ def rect_aperture(Lx, Ly, rays):
     rays[:,filt]=None
     return rays
 
-def knife_edge(axis, rays):
+def knife_edge(axis, rays, edge=1e-1):
     '''
-    Filters rays using a knife edge.
+    Filters rays using a knife edge at edge, in the units of the rays.
     Default is a knife edge in y, can also do a knife edge in x.
     '''
-    if axis is 'y':
+    if axis == 'y':
         a=2
     else:
         a=0
-    filt = rays[a,:] < 1e-1
+    filt = rays[a,:] < edge
     rays[:,filt]=None
     return rays
 
-def lens(f1,f2):
-    '''4x4 symbolic matrix for a thin lens, focal lengths f1 and f2 in orthogonal axes
-    See: https://en.wikipedia.org/wiki/Ray_transfer_matrix_analysis
-    '''
-    l1= sym.Matrix([[1,    0],
-                    [-1/f1, 1]])
-    l2= sym.Matrix([[1,    0],
-                    [-1/f2, 1]])
-    L=sym.zeros(4,4)
-    L[:2,:2]=l1
-    L[2:,2:]=l2
-    return L
-
-def sym_lens(f):
-    '''
-    helper function to create an axisymmetryic lens
-    '''
-    return lens(f,f)
-
-def distance(d):
-    '''4x4 symbolic matrix for travelling a distance d
-    See: https://en.wikipedia.org/wiki/Ray_transfer_matrix_analysis
-    '''
-    d = sym.Matrix([[1, d],
-                    [0, 1]])
-    L=sym.zeros(4,4)
-    L[:2,:2]=d
-    L[2:,2:]=d
-    return L
-
-
-def ray(x, θ, y, ϕ):
-    '''
-    4x1 matrix representing a ray. Spatial units must be consistent, angular units in radians
-    '''
-    return sym.Matrix([x,
-                       θ,
-                       y,
-                       ϕ])  
-
 def d2r(d):
     # helper function, degrees to radians
     return d*np.pi/180
@@ -247,40 +203,96 @@ class Rays:
         """Initialise ray diagnostic.
 
         Args:
-            r0 (4xN float array): N rays, [x, theta, y, phi]
-            L (int, optional): Length scale L. First lens is at L. Defaults to 400.
-            R (int, optional): Radius of lenses. Defaults to 25.
-            Lx (int, optional): Detector size in x. Defaults to 18.
-            Ly (float, optional): Detector size in y. Defaults to 13.5.
+            r0 (4xN float array): N rays, [x, theta, y, phi]. A RayBuffer in any length unit, or a plain array in mm.
+            L (int, optional): Length scale L in mm. First lens is at L. Defaults to 400.
+            R (int, optional): Radius of lenses in mm. Defaults to 25.
+            Lx (int, optional): Detector size in x in mm. Defaults to 18.
+            Ly (float, optional): Detector size in y in mm. Defaults to 13.5.
         """        
         self.r0, self.L, self.R, self.Lx, self.Ly = r0, L, R, Lx, Ly
-    def histogram(self, bin_scale=10, pix_x=3448, pix_y=2574, clear_mem=False):
+        self.set_unit(unit_of(r0))
+
+    def set_unit(self, unit):
+        """Set the length unit of the rays. The optics are scaled to this unit, so the rays never need converting.
+        The bin edges of the image are always reported in mm.
+
+        Args:
+            unit (str): a key of optics.length_units, eg. 'm'
+        """
+        self.unit = unit
+        self.scale = unit_scale('mm', unit) # converts the mm lengths of the optics to ray units
+
+    def histogram(self, bin_scale=10, pix_x=3448, pix_y=2574, clear_mem=False, deposition='ngp', weights=None, camera=None):
         """Bin data into a histogram. Defaults are for a KAF-8300.
         Outputs are H, the histogram, and xedges and yedges, the bin edges.
 
+        The rays are binned once at the native pix_x x pix_y resolution and kept in self.detector,
+        H is then found by summing blocks of bin_scale pixels. Use rebin to change bin_scale afterwards,
+        even if the rays have been cleared.
+
         Args:
             bin_scale (int, optional): bin size, same in x and y. Defaults to 10.
             pix_x (int, optional): number of x pixels in detector plane. Defaults to 3448.
             pix_y (int, optional): number of y pixels in detector plane. Defaults to 2574.
-        """        
-        x=self.rf[0,:]
-        y=self.rf[2,:]
-
-        x=x[~np.isnan(x)]
-        y=y[~np.isnan(y)]
-
-        self.H, self.xedges, self.yedges = np.histogram2d(x, y, 
-                                           bins=[pix_x//bin_scale, pix_y//bin_scale], 
-                                           range=[[-self.Lx/2, self.Lx/2],[-self.Ly/2,self.Ly/2]])
-        self.H = self.H.T
+            clear_mem (bool, optional): clear the rays after binning. Defaults to False.
+            deposition (str, optional): 'ngp' nearest pixel, 'cic' cloud-in-cell or 'tsc' triangular-shaped-cloud. Defaults to 'ngp'.
+            weights (N float, optional): weight of each ray, eg. intensity. Defaults to None.
+            camera (str, optional): a preset from detector.cameras, overrides pix_x, pix_y, Lx and Ly. Defaults to None.
+        """
+        Lx, Ly = self.Lx, self.Ly
+        if camera is not None: # for this image only, self.Lx and self.Ly are kept
+            c = cameras[camera]
+            pix_x, pix_y, Lx, Ly = c['pix_x'], c['pix_y'], c['Lx'], c['Ly']
+
+        scale = getattr(self, 'scale', 1.0) # Rays pickled before set_unit existed are in mm
+        self.detector = Detector(pix_x, pix_y, Lx*scale, Ly*scale, deposition=deposition)
+        self.detector.accumulate(self.rf, weights=weights)
+        self.rebin(bin_scale)
 
         # Optional - clear ray attributes to save memory
         if(clear_mem):
             self.clear_rays()
 
+    def rebin(self, bin_scale):
+        """Derive H at a new bin_scale from the native resolution detector, without rebinning the rays.
+
+        Args:
+            bin_scale (int): bin size, same in x and y.
+        """
+        self.H, xedges, yedges = self.detector.rebin(bin_scale)
+        scale = getattr(self, 'scale', 1.0) # as in histogram
+        self.xedges, self.yedges = xedges/scale, yedges/scale
+
+    def replay(self, store, max_rays=int(1e6), bin_scale=10, pix_x=3448, pix_y=2574,
+               deposition='ngp', intensity=False, solve_kwargs=None):
+        """Image rays from a ray_store.RayStore, a bundle at a time, so memory use is bounded by max_rays.
+        The result is accumulated at native resolution, as in histogram.
+        The optics are scaled to the length unit of the store, so the stored rays are only cast to float64.
+
+        Args:
+            store (ray_store.RayStore): stored rays, eg. written by ElectronCube.solve
+            max_rays (int, optional): number of rays loaded at once. Defaults to 1e6.
+            bin_scale (int, optional): bin size, same in x and y. Defaults to 10.
+            pix_x (int, optional): number of x pixels in detector plane. Defaults to 3448.
+            pix_y (int, optional): number of y pixels in detector plane. Defaults to 2574.
+            deposition (str, optional): 'ngp', 'cic' or 'tsc'. Defaults to 'ngp'.
+            intensity (bool, optional): weight rays by |E|^2 from the stored Jones vectors. Defaults to False.
+            solve_kwargs (dict, optional): passed to solve, eg. dict(displacement=0). Defaults to None.
+        """
+        if intensity and not store.jones:
+            raise ValueError("intensity=True needs a RayStore made with jones=True")
+        self.set_unit(store.unit)
+        self.detector = Detector(pix_x, pix_y, self.Lx*self.scale, self.Ly*self.scale, deposition=deposition)
+        for rays, jones in store.chunks(max_rays):
+            self.r0 = RayBuffer(np.array(rays, dtype=np.float64), store.unit) # read this bundle into memory
+            self.solve(**(solve_kwargs or {}))
+            weights = (np.abs(jones)**2).sum(axis=0) if intensity else None
+            self.detector.accumulate(self.rf, weights=weights)
+            self.clear_rays()
+        self.rebin(bin_scale)
+
     def plot(self, ax, clim=None, cmap=None):
-        ax.imshow(self.H, interpolation='nearest', origin='low', clim=clim, cmap=cmap,
-                extent=[self.xedges[0], self.xedges[-1], self.yedges[0], self.yedges[-1]])
+        plot_histogram(self.H, self.xedges, self.yedges, ax, clim=clim, cmap=cmap)
 
     def clear_rays(self):
         '''
@@ -295,16 +307,17 @@ class BurdiscopeRays(Rays):
     '''              
     def solve(self):
         O=BurdiscopeOptics
+        L, R = self.L*self.scale, self.R*self.scale # in the units of the rays
         
         rr0=transform(O.X3(0), self.r0) # small displacement, currently does nothing
 
-        rr1=transform(O.L1(self.L), rr0) # first lens
-        r1=circular_aperture(self.R, rr1) # first lens cutoff
+        rr1=transform(O.L1(L), rr0) # first lens
+        r1=circular_aperture(R, rr1) # first lens cutoff
 
-        rr2=transform(O.L2(self.L), r1) # second lens
-        r2=circular_aperture(self.R, rr2) # second lens cutoff
+        rr2=transform(O.L2(L), r1) # second lens
+        r2=circular_aperture(R, rr2) # second lens cutoff
 
-        rr3=transform(O.X3(self.L), r2) #detector
+        rr3=transform(O.X3(L), r2) #detector
         #3=rect_aperture(self.Lx/2,self.Ly/2,rr3) # detector cutoff
         self.rf=rr3
         
@@ -314,16 +327,17 @@ class ShadowgraphyRays(Rays):
     '''              
     def solve(self, displacement=10):
         O=ShadowgraphyOptics
+        L, R = self.L*self.scale, self.R*self.scale # in the units of the rays
         
-        rr0=transform(O.X3(displacement), self.r0) #small displacement
+        rr0=transform(O.X3(displacement*self.scale), self.r0) #small displacement
         
-        rr1=transform(O.L1(self.L), rr0) #lens 1
-        r1=circular_aperture(self.R, rr1) # cut off
+        rr1=transform(O.L1(L), rr0) #lens 1
+        r1=circular_aperture(R, rr1) # cut off
 
-        rr2=transform(O.L2(self.L), r1) #lens 2
-        r2=circular_aperture(self.R, rr2) # cut off
+        rr2=transform(O.L2(L), r1) #lens 2
+        r2=circular_aperture(R, rr2) # cut off
 
-        rr3=transform(O.X3(self.L), r2) #detector
+        rr3=transform(O.X3(L), r2) #detector
         #r3=rect_aperture(self.Lx/2,self.Ly/2,rr3) #cut off
         self.rf=rr3
         
@@ -333,18 +347,19 @@ class SchlierenRays(Rays):
     '''              
     def solve(self):
         O=SchlierenOptics
+        L, R = self.L*self.scale, self.R*self.scale # in the units of the rays
         
         rr0=transform(O.X3(0), self.r0) #small displacement
 
-        rr1=transform(O.L1(self.L), rr0) #first lens
-        r1=circular_aperture(self.R, rr1) #cut off
+        rr1=transform(O.L1(L), rr0) #first lens
+        r1=circular_aperture(R, rr1) #cut off
 
-        rrk=transform(O.X2(self.L), r1) #fourier plane
-        rk=knife_edge('y', rrk) #knife edge cuts off y.
+        rrk=transform(O.X2(L), r1) #fourier plane
+        rk=knife_edge('y', rrk, edge=1e-1*self.scale) #knife edge cuts off y.
 
-        rr2=transform(O.L2(self.L), rk) #second lens
-        r2=circular_aperture(self.R, rr2) #cut off
+        rr2=transform(O.L2(L), rk) #second lens
+        r2=circular_aperture(R, rr2) #cut off
 
-        rr3=transform(O.X3(self.L), r2) #detector
+        rr3=transform(O.X3(L), r2) #detector
         #r3=rect_aperture(self.Lx/2,self.Ly/2,rr3) #cut off
         self.rf=rr3
@@ -0,0 +1,131 @@
+"""
+Lightweight result files for post-processing synthetic diagnostics.
+
+A result directory holds, for each diagnostic, its image and bin edges as .npy files, plus a meta.json.
+Images are memory mapped when opened, so a subset of diagnostics, or a region of interest of an image,
+can be plotted without reading everything. This module only needs numpy, so plotting jobs
+do not have to import ray_transfer_matrix (and through it sympy).
+
+Example:
+    save_results('./output/', Schlieren=sc, Shadowgraphy=sh, Burdiscope=b)
+
+    r = open_results('./output/', names=['Schlieren'])
+    sc = r['Schlieren'].roi(xlim=[-5,5], ylim=[-5,5])
+    sc.plot(ax, clim=[0,300], cmap='gray')
+
+    # Existing pickles can be converted once
+    convert_pickles({'Schlieren': 'Schlieren.pkl', 'Burdiscope': 'Burdiscope.pkl'}, './output/')
+"""
+
+import numpy as np
+import json
+import os
+import pickle
+
+class DetectorImage:
+    """An image and its bin edges. H is stored as H[y,x].
+    """
+    def __init__(self, H, xedges, yedges, meta=None):
+        self.H, self.xedges, self.yedges = H, xedges, yedges
+        self.meta = {} if meta is None else meta
+
+    def roi(self, xlim=None, ylim=None):
+        """Select a region of interest. The image is sliced, not copied, so it stays memory mapped.
+
+        Args:
+            xlim (2 float, optional): [xmin, xmax] in the units of the edges. Defaults to None, the whole image.
+            ylim (2 float, optional): [ymin, ymax]. Defaults to None, the whole image.
+
+        Returns:
+            DetectorImage: the pixels which overlap the region
+        """
+        ix0, ix1 = self._bounds(self.xedges, xlim)
+        iy0, iy1 = self._bounds(self.yedges, ylim)
+        return DetectorImage(self.H[iy0:iy1, ix0:ix1], self.xedges[ix0:ix1+1], self.yedges[iy0:iy1+1], self.meta)
+
+    @staticmethod
+    def _bounds(edges, lim):
+        """First and one past last pixel overlapping lim"""
+        if lim is None:
+            return 0, edges.size-1
+        i0 = max(np.searchsorted(edges, lim[0], side='right')-1, 0)
+        i1 = min(np.searchsorted(edges, lim[1], side='left'), edges.size-1)
+        return i0, i1
+
+    def plot(self, ax, clim=None, cmap=None):
+        ax.imshow(self.H, interpolation='nearest', origin='lower', clim=clim, cmap=cmap,
+                extent=[self.xedges[0], self.xedges[-1], self.yedges[0], self.yedges[-1]])
+
+def _describe(diagnostic):
+    """Collect the JSON serialisable settings of a diagnostic, eg. a Rays object"""
+    meta = dict(type=type(diagnostic).__name__)
+    for k in ('L', 'R', 'Lx', 'Ly'):
+        v = getattr(diagnostic, k, None)
+        if v is not None:
+            meta[k] = float(v)
+    d = getattr(diagnostic, 'detector', None)
+    if d is not None:
+        meta.update(pix_x=d.nx, pix_y=d.ny, deposition=d.deposition)
+    return meta
+
+def save_results(path, metadata=None, **diagnostics):
+    """Save the images of diagnostics to a result directory.
+    Diagnostics with the same name already in the directory are overwritten, others are kept.
+
+    Args:
+        path (str): result directory
+        metadata (dict, optional): JSON serialisable run information, eg. number of rays. Defaults to None.
+        **diagnostics: name=object, where object has H, xedges and yedges (eg. a Rays or DetectorImage)
+    """
+    os.makedirs(path, exist_ok=True)
+    meta_file = os.path.join(path, 'meta.json')
+    meta = dict(run={}, diagnostics={})
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+    if metadata is not None:
+        meta['run'].update(metadata)
+
+    for name, d in diagnostics.items():
+        for k in ('H', 'xedges', 'yedges'):
+            np.save(os.path.join(path, "%s.%s.npy"%(name, k)), np.asarray(getattr(d, k)))
+        meta['diagnostics'][name] = d.meta if isinstance(d, DetectorImage) else _describe(d)
+
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f, indent=1)
+
+def open_results(path, names=None):
+    """Open a result directory. Images are memory mapped, not read.
+
+    Args:
+        path (str): result directory
+        names (list of str, optional): diagnostics to open. Defaults to None, all of them.
+
+    Returns:
+        dict: name -> DetectorImage
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    names = meta['diagnostics'].keys() if names is None else names
+
+    results = {}
+    for name in names:
+        load = lambda k, **kw: np.load(os.path.join(path, "%s.%s.npy"%(name, k)), **kw)
+        results[name] = DetectorImage(load('H', mmap_mode='r'), load('xedges'), load('yedges'),
+                                      dict(meta['diagnostics'][name], run=meta['run']))
+    return results
+
+def convert_pickles(pickles, path, metadata=None):
+    """Convert pickled diagnostics (eg. from older runs of example_MPI.py) to a result directory.
+    Unpickling needs ray_transfer_matrix to be importable, but only this once.
+
+    Args:
+        pickles (dict): name -> pickle file name
+        path (str): result directory
+        metadata (dict, optional): JSON serialisable run information. Defaults to None.
+    """
+    diagnostics = {}
+    for name, filename in pickles.items():
+        with open(filename, 'rb') as f:
+            diagnostics[name] = pickle.load(f)
+    save_results(path, metadata=metadata, **diagnostics)
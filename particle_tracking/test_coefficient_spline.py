@@ -0,0 +1,18 @@
+import os
+import sys
+import numpy as np
+from scipy.interpolate import RectBivariateSpline
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gaussian_fields'))
+import paraxial_solver as ps
+
+def test_coefficient_spline_matches_fitted():
+    """A spline rebuilt from cached knots and coefficients evaluates as the fitted one, inside and beyond the grid"""
+    y = np.linspace(-2, 2, 41)
+    x = np.linspace(-3, 3, 31)
+    fitted = RectBivariateSpline(y, x, np.sin(y)[:,None]*np.cos(2*x)[None,:])
+    tx, ty = fitted.get_knots()
+    rebuilt = ps.spline_from_coefficients(tx, ty, fitted.get_coeffs())
+
+    rng = np.random.default_rng(0)
+    ys, xs = rng.uniform(-2.5, 2.5, 1000), rng.uniform(-3.5, 3.5, 1000)
+    assert np.allclose(rebuilt(ys, xs, grid=False), fitted(ys, xs, grid=False), rtol=0, atol=1e-12)
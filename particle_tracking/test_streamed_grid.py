@@ -0,0 +1,19 @@
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gaussian_fields'))
+import paraxial_solver as ps
+from grid_source import ArraySlices
+
+def test_streamed_grid_screen_error():
+    """screen_error, inherited from GridTracer, runs on a StreamedGrid and agrees with the in-memory grid"""
+    np.random.seed(0)
+    with np.errstate(divide='ignore', invalid='ignore'): # k=0 of the spectrum
+        grid = ps.TurbulentGrid(10, ps.k41_3D, 1e19, 1e18, 2.0)
+    streamed = ps.StreamedGrid(ArraySlices(grid.ne_grid), grid.x, grid.y, grid.z)
+    r0 = ps.generate_collimated_beam(1000, 3)
+
+    error = streamed.screen_error(r0, K=2)
+    expected = grid.screen_error(r0, K=2)
+    for k, v in expected.items():
+        assert np.isclose(error[k], v, rtol=1e-12, atol=0), k
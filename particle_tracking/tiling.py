@@ -0,0 +1,78 @@
+"""
+Periodic tiling of a density box, for path lengths much longer than the box which can be afforded.
+
+Fields from turboGen's FFT generators are periodic, so a box can be repeated along the probing direction (z)
+without a seam, and rays which leave through the sides re-enter on the opposite side.
+Only the one box is kept in memory, however many tiles the rays cross.
+
+Repeating the same box correlates the deflections of successive tiles. Each tile can instead use the box
+shifted by a random fraction of its period in x and y, and/or reflected in x and y.
+Shifts keep the box periodic, so the only seams are at the faces between tiles, where the density is continuous
+on average but not slice by slice.
+
+Positions are mapped into the box with Tiling.local, which also returns the sign the x or y gradient picks up
+under reflection. The box spans [origin, origin+period) on each axis, where period = number of points * spacing,
+one spacing more than the span of the coordinates, so grids are padded with periodic_pad before interpolation.
+
+Example:
+    cube.tile(10, shifts=True, reflections=True, rng=1) # ElectronCube, 10 boxes along z
+    cube.calc_dndr()
+
+    grid.tile(10, shifts=True, rng=1) # paraxial GridTracer
+    grid.solve(r0)
+"""
+
+import numpy as np
+
+def periodic_pad(a, axes):
+    """Append the first slice of a to its end along each of axes, so a periodic grid covers a whole period"""
+    for axis in axes:
+        a = np.concatenate((a, np.take(a, [0], axis=axis)), axis=axis)
+    return a
+
+def periodic_gradient(a, spacing, axis):
+    """Second order centred differences, wrapping around the ends of a periodic grid, as np.gradient in the interior"""
+    return (np.roll(a, -1, axis=axis)-np.roll(a, 1, axis=axis))/(2*spacing)
+
+def grid_period(u):
+    """Period of an evenly spaced periodic grid u: the number of points times the spacing"""
+    return u.size*(u[1]-u[0])
+
+class Tiling:
+    """A number of tiles along z, each with its own shift and reflection in x and y.
+    """
+    def __init__(self, n_tiles, shifts=False, reflections=False, rng=None):
+        """
+        Args:
+            n_tiles (int): number of boxes along z
+            shifts (bool, optional): shift each tile by a random fraction of the period in x and y. Defaults to False.
+            reflections (bool, optional): reflect each tile in x and/or y at random. Defaults to False.
+            rng (numpy Generator or int, optional): random number generator, or a seed for one. Defaults to None.
+        """
+        if n_tiles < 1:
+            raise ValueError("n_tiles must be at least 1")
+        rng = np.random.default_rng(rng)
+        self.n_tiles = int(n_tiles)
+        self.shift = rng.random((self.n_tiles, 2)) if shifts else np.zeros((self.n_tiles, 2))
+        self.flip = rng.choice([-1.0, 1.0], (self.n_tiles, 2)) if reflections else np.ones((self.n_tiles, 2))
+        self.shift[0], self.flip[0] = 0.0, 1.0 # the first tile is the box itself
+
+    def local(self, i, u, axis, origin, period):
+        """Map a transverse coordinate in tile i into the box.
+
+        Args:
+            i (int or N int): tile of each position
+            u (N float): x (axis 0) or y (axis 1) positions
+            axis (int): 0 for x, 1 for y
+            origin (float): lowest coordinate of the box
+            period (float): period of the box
+
+        Returns:
+            N float, float or N float: positions in [origin, origin+period), and the sign of the gradient along axis
+        """
+        flip = self.flip[i, axis]
+        return origin+np.mod(flip*(u-origin)+self.shift[i, axis]*period, period), flip
+
+    def describe(self):
+        """JSON serialisable description, for provenance"""
+        return dict(n_tiles=self.n_tiles, shift=self.shift.tolist(), flip=self.flip.tolist())